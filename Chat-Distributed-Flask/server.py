@@ -1,28 +1,589 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
+import atexit
+import bisect
 import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import re
+import sys
+import threading
+import time
+import zlib
+from urllib.parse import unquote
+from collections import OrderedDict
 import redis as Redis
+from redis.cluster import RedisCluster
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
-redis = Redis.StrictRedis(host='host.docker.internal', port=6379, decode_responses=True)
-
-
-def get_room(room_name):
-    room_data = redis.get(f"room:{room_name}")
-    return json.loads(room_data) if room_data else None
-
-def save_room(room_name, room_data):
-    redis.set(f"room:{room_name}", json.dumps(room_data))
-    redis.sadd("rooms", room_name)
-
-def get_user(user_name):
-    user_data = redis.get(f"user:{user_name}")
-    return json.loads(user_data) if user_data else None
-
-def save_user(user_name, user_data):
-    redis.set(f"user:{user_name}", json.dumps(user_data))
+# Redis server, or any node of the Redis Cluster when CHAT_REDIS_CLUSTER is 1. The cluster
+# client learns the slot map from that node and sends each command to the node owning its keys.
+REDIS_HOST = os.environ.get("CHAT_REDIS_HOST", "host.docker.internal")
+REDIS_PORT = int(os.environ.get("CHAT_REDIS_PORT", 6379))
+REDIS_CLUSTER = os.environ.get("CHAT_REDIS_CLUSTER", "0") == "1"
+# Number of sets the room directory is split into, spread over the cluster nodes
+DIRECTORY_SHARDS = int(os.environ.get("CHAT_DIRECTORY_SHARDS", 16))
+
+# Default and maximum number of seconds a /subscribe long-poll is held open
+SUBSCRIBE_TIMEOUT = 30
+SUBSCRIBE_MAX_TIMEOUT = 60
+# Maximum number of messages per room read from Redis at once by /subscribe
+SUBSCRIBE_BATCH = 100
+# Messages queued for a subscriber that does not keep up before it reads them from the
+# streams instead
+SUBSCRIBER_BACKLOG = 1000
+# Seconds the listener waits for a message before checking for rooms to (un)subscribe
+LISTEN_INTERVAL = 0.05
+# Entries of the near-cache of room existence and memberships kept in memory (0 disables
+# it), and the seconds they are trusted without hearing of a change
+NEAR_CACHE_SIZE = int(os.environ.get("CHAT_NEAR_CACHE_SIZE", 100000))
+NEAR_CACHE_TTL = float(os.environ.get("CHAT_NEAR_CACHE_TTL", 5))
+# Pub/Sub channel the removed memberships are announced on, every server drops them from its cache
+INVALIDATION_CHANNEL = "chat:invalidate"
+
+if REDIS_CLUSTER:
+    redis = RedisCluster(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+else:
+    redis = Redis.StrictRedis(host=REDIS_HOST, port=REDIS_PORT, decode_responses=True)
+
+# Minimum level of the log records written, and the fraction of the records below WARNING
+# that are kept (1 keeps them all, 0.01 one in a hundred)
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("CHAT_LOG_SAMPLE_RATE", 1))
+
+# Upper bounds in seconds of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# Attributes every log record has, the other ones are the fields passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+# Write each log record as one JSON object holding the event and its fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname, "event": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger("chat")
+
+# Records are queued by the request threads and written by a background thread, so
+# logging never waits on stdout. Below WARNING only a LOG_SAMPLE_RATE fraction is kept.
+def setup_logging():
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if LOG_SAMPLE_RATE < 1:
+        handler.addFilter(lambda record: record.levelno >= logging.WARNING or random.random() < LOG_SAMPLE_RATE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+# Estimate a quantile from the counts of a latency histogram by interpolating inside the
+# bucket it falls in
+def quantile(counts, q):
+    rank = q * sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            high = LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return 0.0
+
+
+# Request counts and latency histograms of this server per route, in the Prometheus text
+# format. The near-cache adds its own counters to /metrics.
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = {}
+        # [counts per bucket of LATENCY_BUCKETS and one for slower requests, total seconds] by endpoint
+        self.latencies = {}
+
+    def observe(self, endpoint, status, seconds):
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latencies.get(endpoint)
+            if histogram is None:
+                histogram = self.latencies[endpoint] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+
+    def render(self):
+        name = self.prefix + "_requests_total"
+        lines = [f"# TYPE {name} counter"]
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latencies = [(endpoint, list(counts), total) for endpoint, (counts, total) in sorted(self.latencies.items())]
+        for (endpoint, status), count in requests:
+            lines.append(f'{name}{{endpoint="{endpoint}",status="{status}"}} {count}')
+        name = self.prefix + "_request_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        quantiles = []
+        for endpoint, counts, total in latencies:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {total}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {cumulative}')
+            for q in (0.5, 0.9, 0.99):
+                quantiles.append(f'{name}_quantile{{endpoint="{endpoint}",quantile="{q}"}} '
+                                 f'{quantile(counts, q):.6f}')
+        lines.append(f"# TYPE {name}_quantile gauge")
+        lines.extend(quantiles)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics("chat")
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+# Count every routed request and time it until its response is ready
+@app.after_request
+def record_request(response):
+    start = g.get("request_start")
+    if start is not None and request.url_rule is not None and request.url_rule.rule != "/metrics":
+        metrics.observe(request.url_rule.rule, response.status_code, time.perf_counter() - start)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render() + near_cache.render("chat"), mimetype="text/plain; version=0.0.4")
+
+setup_logging()
+
+
+# A room is stored as three keys: room:{<name>} holds its metadata as JSON,
+# room:{<name>}:members is the set of its users and room:{<name>}:messages is a Redis
+# Stream with one entry per message. Sending a message is a single XADD, so the history
+# is never read or rewritten to add to it and sends from several servers at once cannot
+# overwrite each other. A user is stored as user:{<name>} with its metadata. Memberships
+# are only kept in the members set of the room, so a join or a leave changes a single key.
+# In a cluster only the part of a key between braces picks its slot, so all the keys of
+# a room are on the same node and a script can use them together.
+def room_key(room_name):
+    return f"room:{hash_tag(room_name)}"
+
+def members_key(room_name):
+    return f"room:{hash_tag(room_name)}:members"
+
+def messages_key(room_name):
+    return f"room:{hash_tag(room_name)}:messages"
+
+def user_key(user_name):
+    return f"user:{hash_tag(user_name)}"
+
+# The slot is picked by what is between the first { and the first } after it, and the whole
+# key when that is empty. %, { and } are escaped in names so the tag is always the whole name.
+TAG_ESCAPES = str.maketrans({"%": "%25", "{": "%7B", "}": "%7D"})
+
+def hash_tag(name):
+    return "{" + name.translate(TAG_ESCAPES) + "}"
+
+# The room names are split between DIRECTORY_SHARDS sets by a hash of the name, with a
+# different hash tag each so they are spread over the nodes instead of one key getting
+# every room creation and listing
+def directory_key(shard):
+    return f"rooms:{{{shard}}}"
+
+def directory_shard(room_name):
+    return zlib.crc32(room_name.encode()) % DIRECTORY_SHARDS
+
+# Save a new room, returns False if a room with that name already exists. The room and its
+# name in the directory are written in one pipeline: when the room already exists its name
+# is already there and adding it again changes nothing.
+def create_room_data(room_name, room_data):
+    pipe = redis.pipeline(transaction=False)
+    pipe.set(room_key(room_name), json.dumps(room_data), nx=True)
+    pipe.sadd(directory_key(directory_shard(room_name)), room_name)
+    created, _ = pipe.execute()
+    return bool(created)
+
+# The names of all the rooms, read from every directory set in one pipeline
+def room_names():
+    pipe = redis.pipeline(transaction=False)
+    for shard in range(DIRECTORY_SHARDS):
+        pipe.smembers(directory_key(shard))
+    return sorted(name for names in pipe.execute() for name in names)
+
+# Save a new user, returns False if a user with that name already exists
+def create_user_data(user_name, user_data):
+    return bool(redis.set(user_key(user_name), json.dumps(user_data), nx=True))
+
+# Membership changes and sends run as Lua scripts on the keys of the room. Redis runs a
+# script without running any other command in the middle, so requests from several servers
+# cannot interleave. Users are never removed, so whether a user exists is checked before
+# the script, through the near-cache.
+
+# KEYS: room, room members. ARGV: user name.
+# Returns 0 if the room does not exist, 1 once the user is a member.
+ROOM_JOIN_SCRIPT = redis.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+return 1
+""")
+
+# KEYS: room, room members. ARGV: user name, invalidation channel, invalidation message.
+# Returns -2 if the room does not exist, -3 if the user is not a member and 1 once it left,
+# which is announced to the near-caches of the servers.
+ROOM_LEAVE_SCRIPT = redis.register_script("""
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return -2
+end
+if redis.call('SREM', KEYS[2], ARGV[1]) == 0 then
+    return -3
+end
+redis.call('PUBLISH', ARGV[2], ARGV[3])
+return 1
+""")
+
+# KEYS: room members, room messages. ARGV: user name, message, timestamp, room channel.
+# Adds the message if the user is a member, publishes it on the channel of the room for
+# the servers with subscribers in it and returns its id, false otherwise. The timestamp is
+# published as the string stored in the stream: cjson would round it to 14 digits.
+SEND_SCRIPT = redis.register_script("""
+if redis.call('SISMEMBER', KEYS[1], ARGV[1]) == 0 then
+    return false
+end
+local id = redis.call('XADD', KEYS[2], '*', 'user', ARGV[1], 'msg', ARGV[2], 'timestamp', ARGV[3])
+redis.call('PUBLISH', ARGV[4], cjson.encode({id = id, user = ARGV[1], msg = ARGV[2], timestamp = ARGV[3]}))
+return id
+""")
+
+# Returns True once the user is a member, False if the user or the room does not exist
+def join(user_name, room_name):
+    if not user_exists(user_name):
+        return False
+    return bool(ROOM_JOIN_SCRIPT(keys=[room_key(room_name), members_key(room_name)], args=[user_name]))
+
+# Returns 1 once the user left, -1 if the user does not exist, -2 if the room does not
+# exist and -3 if the user is not a member. Only a member exists for sure, whether the
+# user does is only looked up when it is not one.
+def leave(user_name, room_name):
+    key = member_cache_key(user_name, room_name)
+    result = ROOM_LEAVE_SCRIPT(keys=[room_key(room_name), members_key(room_name)],
+                               args=[user_name, INVALIDATION_CHANNEL, json.dumps(key)])
+    if result == 1:
+        # The announcement reaches this server too, but later requests must not wait for it
+        near_cache.invalidate(key)
+    elif result == -3 and not user_exists(user_name):
+        return -1
+    return result
+
+def user_exists(user_name):
+    return near_cache.load(("user", user_name), lambda: bool(redis.exists(user_key(user_name))))
+
+def member_cache_key(user_name, room_name):
+    return ("member", room_name, user_name)
+
+def is_member(user_name, room_name):
+    return near_cache.load(member_cache_key(user_name, room_name),
+                           lambda: bool(redis.sismember(members_key(room_name), user_name)))
+
+# Add a message if the user is a member of the room, returns its id or None
+def send(user_name, room_name, msg):
+    keys = [members_key(room_name), messages_key(room_name)]
+    return SEND_SCRIPT(keys=keys, args=[user_name, msg, time.time(), room_channel(room_name)])
+
+# Pub/Sub channel of the new messages of a room
+def room_channel(room_name):
+    return f"room:{hash_tag(room_name)}:events"
+
+CHANNEL_PREFIX = "room:{"
+CHANNEL_SUFFIX = "}:events"
+
+# Stream ids in the order of the messages
+def id_order(message_id):
+    ms, _, seq = message_id.partition("-")
+    return (int(ms), int(seq or 0))
+
+# In-process LRU cache of the answers of Redis to "does this room exist", "does this user
+# exist" and "is this user a member of this room", the checks of /can-send, /get-messages,
+# /subscribe and of joins. Only positive answers are kept: rooms and users are never
+# removed, and a membership only ends through a leave,
+# which is published on INVALIDATION_CHANNEL and dropped by the listener of every server. An
+# answer read before an invalidation is not stored after it, entries expire after ttl
+# seconds in case an announcement is missed, and the cache is only used while the listener
+# is subscribed to the channel, starting empty each time.
+class NearCache:
+    def __init__(self, size, ttl):
+        self.size = size
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Value and expiry time by key, least recently used first
+        self.entries = OrderedDict()
+        self.active = False
+        # Incremented on every invalidation
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    # The cached value of key, or the one fetch returns
+    def load(self, key, fetch):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > now:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+            generation = self.generation
+            active = self.active
+        value = fetch()
+        if value and active:
+            with self.lock:
+                if self.active and self.generation == generation:
+                    self.entries[key] = (value, now + self.ttl)
+                    self.entries.move_to_end(key)
+                    while len(self.entries) > self.size:
+                        self.entries.popitem(last=False)
+                        self.evictions += 1
+        return value
+
+    def invalidate(self, key):
+        with self.lock:
+            self.generation += 1
+            if self.entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    # Start caching once the invalidations are received, or stop when they may be missed
+    def enable(self, active):
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+            self.active = active and self.size > 0
+
+    def render(self, prefix):
+        name = prefix + "_near_cache"
+        with self.lock:
+            stats = [("hits_total", "counter", self.hits), ("misses_total", "counter", self.misses),
+                     ("evictions_total", "counter", self.evictions),
+                     ("invalidations_total", "counter", self.invalidations),
+                     ("entries", "gauge", len(self.entries))]
+        lines = []
+        for stat, kind, value in stats:
+            lines.append(f"# TYPE {name}_{stat} {kind}")
+            lines.append(f"{name}_{stat} {value}")
+        return "\n".join(lines) + "\n"
+
+near_cache = NearCache(NEAR_CACHE_SIZE, NEAR_CACHE_TTL)
+
+# A client of /subscribe on this server. The listener queues the new messages of its rooms
+# and wakes it up. If it falls SUBSCRIBER_BACKLOG messages behind, the queue is dropped
+# and it reads from the streams instead.
+class Subscriber:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.messages = []
+        self.resync = False
+
+    def push(self, room_name, message):
+        with self.condition:
+            if len(self.messages) >= SUBSCRIBER_BACKLOG:
+                self.messages.clear()
+                self.resync = True
+            elif not self.resync:
+                self.messages.append((room_name, message))
+            self.condition.notify_all()
+
+    # Messages may have been missed, they have to be read from the streams
+    def lost(self):
+        with self.condition:
+            self.messages.clear()
+            self.resync = True
+            self.condition.notify_all()
+
+    # Wait until there is something or the timeout expires and return the queued messages
+    # and whether the streams have to be read
+    def wait(self, timeout):
+        with self.condition:
+            if not self.messages and not self.resync:
+                self.condition.wait(timeout)
+            messages, resync = self.messages, self.resync
+            self.messages = []
+            self.resync = False
+            return messages, resync
+
+# Every server has one Redis connection subscribed to the channels of the rooms its
+# clients follow, read by a background thread that hands the messages to the clients.
+# The request threads only change the rooms wanted; the thread subscribes and unsubscribes
+# the connection. ready(room) is set once Redis confirmed the subscription, from then on
+# every new message of the room reaches the subscribers.
+class Listener:
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Subscribers by room name
+        self.subscribers = {}
+        # Set once the channel of a room is subscribed, by room name
+        self.ready = {}
+        self.changes = queue.SimpleQueue()
+        self.thread = None
+
+    def start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, name="listener", daemon=True)
+                self.thread.start()
+
+    def add(self, room_name, subscriber):
+        self.start()
+        with self.lock:
+            subscribers = self.subscribers.setdefault(room_name, set())
+            if not subscribers:
+                self.ready[room_name] = threading.Event()
+                self.changes.put(room_name)
+            subscribers.add(subscriber)
+            return self.ready[room_name]
+
+    def remove(self, room_name, subscriber):
+        with self.lock:
+            subscribers = self.subscribers.get(room_name)
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self.subscribers[room_name]
+                del self.ready[room_name]
+                self.changes.put(room_name)
+
+    def run(self):
+        reconnecting = False
+        while True:
+            pubsub = redis.pubsub()
+            # Channels subscribed on the connection, and subscriptions not confirmed yet
+            subscribed = set()
+            pending = {}
+            # Rooms followed while the connection was lost
+            recovering = set()
+            try:
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                with self.lock:
+                    for room_name in self.subscribers:
+                        self.changes.put(room_name)
+                    if reconnecting:
+                        recovering.update(self.subscribers)
+                while True:
+                    while True:
+                        try:
+                            room_name = self.changes.get_nowait()
+                        except queue.Empty:
+                            break
+                        with self.lock:
+                            wanted = room_name in self.subscribers
+                        if wanted and room_name not in subscribed:
+                            pubsub.subscribe(room_channel(room_name))
+                            subscribed.add(room_name)
+                            pending[room_name] = pending.get(room_name, 0) + 1
+                        elif wanted and not pending.get(room_name):
+                            with self.lock:
+                                if room_name in self.ready:
+                                    self.ready[room_name].set()
+                        elif not wanted and room_name in subscribed:
+                            pubsub.unsubscribe(room_channel(room_name))
+                            subscribed.discard(room_name)
+                    message = pubsub.get_message(timeout=LISTEN_INTERVAL)
+                    if message is None or message["type"] not in ("subscribe", "message"):
+                        continue
+                    if message["channel"] == INVALIDATION_CHANNEL:
+                        if message["type"] == "subscribe":
+                            near_cache.enable(True)
+                        else:
+                            near_cache.invalidate(tuple(json.loads(message["data"])))
+                        continue
+                    room_name = unquote(message["channel"][len(CHANNEL_PREFIX):-len(CHANNEL_SUFFIX)])
+                    with self.lock:
+                        subscribers = list(self.subscribers.get(room_name, ()))
+                        if message["type"] == "subscribe":
+                            pending[room_name] -= 1
+                            if not pending[room_name] and room_name in self.ready:
+                                self.ready[room_name].set()
+                                # Messages sent before the subscription was back after a
+                                # lost connection are read from the stream. A new subscription
+                                # reads the stream itself once ready.
+                                if room_name in recovering:
+                                    recovering.discard(room_name)
+                                    for subscriber in subscribers:
+                                        subscriber.lost()
+                            continue
+                    data = json.loads(message["data"])
+                    data["timestamp"] = float(data["timestamp"])
+                    for subscriber in subscribers:
+                        subscriber.push(room_name, data)
+            except Redis.RedisError as e:
+                logger.error("subscription connection lost", extra={"error": str(e)})
+                reconnecting = True
+                near_cache.enable(False)
+                # Messages sent until the channels are subscribed again are read from the streams
+                with self.lock:
+                    for room_name, subscribers in self.subscribers.items():
+                        self.ready[room_name].clear()
+                        for subscriber in subscribers:
+                            subscriber.lost()
+                time.sleep(1)
+            finally:
+                pubsub.close()
+
+listener = Listener()
+# The near-cache is only used while the listener receives the invalidations
+if NEAR_CACHE_SIZE:
+    listener.start()
+
+# Stream entry ids are <milliseconds>-<sequence>, a bare number means <milliseconds>-0
+STREAM_ID = re.compile(r"\d+(-\d+)?")
+
+# Read a non-negative integer field of the request body, None if it is missing
+def get_int_param(data, name):
+    value = data.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(name)
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(name)
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+# Read a stream id field of the request body, None if it is missing
+def get_stream_id(data, name):
+    value = data.get(name)
+    if value is None:
+        return None
+    if not isinstance(value, str) or not STREAM_ID.fullmatch(value):
+        raise ValueError(name)
+    return value
+
+def message_info(entry):
+    entry_id, fields = entry
+    return {"id": entry_id, "user": fields["user"], "msg": fields["msg"], "timestamp": float(fields["timestamp"])}
+
+def room_exists(room_name):
+    return near_cache.load(("room", room_name), lambda: bool(redis.exists(room_key(room_name))))
 
 
 @app.route("/create-room", methods=["POST"])
@@ -31,20 +592,18 @@ def create_room():
     room_name = data.get('room-name')
     if not room_name:
         return jsonify({"error": "room-name is required to create a new room"}), 400
-    if get_room(room_name):
-        print(f"Error: {room_name} already exists.")
+    room = {"room_name": room_name}
+    if not create_room_data(room_name, room):
+        logger.warning("cannot create room", extra={"room": room_name})
         return jsonify({"error": f"Room {room_name} already exists."}), 400
-    room = {"room_name": room_name, "users": [], "messages": []}
-    save_room(room_name, room)
-    print("> Room " + room_name + " created.")
+    logger.info("room created", extra={"room": room_name})
     return jsonify({"success": f"Room {room_name} created"}), 200
 
 
 # Get all the rooms
 @app.route("/get-rooms", methods=["GET"])
 def get_rooms():
-    room_names = redis.smembers("rooms")
-    return jsonify({"rooms": list(room_names)}), 200
+    return jsonify({"rooms": room_names()}), 200
 
 # Add a new user
 @app.route("/add-user", methods=["POST"])
@@ -53,12 +612,11 @@ def add_user():
     user_name = data.get('user-name')
     if not user_name:
         return jsonify({"error": "user-name is required to add user"}), 400
-    if get_user(user_name):
-        print(f"* Cannot add user {user_name}.")
+    user = {"user_name": user_name}
+    if not create_user_data(user_name, user):
+        logger.warning("cannot add user", extra={"user": user_name})
         return jsonify({"error": "User already exists"}), 400
-    user = {"user_name": user_name, "rooms": []}
-    save_user(user_name, user)
-    print(f"> User {user_name} was added.")
+    logger.info("user added", extra={"user": user_name})
     return jsonify({"success": f"User {user_name} added"}), 200
 
 
@@ -72,17 +630,10 @@ def join_room():
     if not user_name or not room_name:
         return jsonify({"error": "user-name and room-name are required to join room"}), 400
 
-    user = get_user(user_name)
-    room = get_room(room_name)
-    if not user or not room:
-        print(f"* User {user_name} cannot join {room_name}")
+    if not join(user_name, room_name):
+        logger.warning("user cannot join room", extra={"user": user_name, "room": room_name})
         return jsonify({"error": f"User {user_name} cannot join {room_name}"}), 400
-    if user_name not in room["users"]:
-        room["users"].append(user_name)
-        save_room(room_name, room)
-    if room_name not in user["rooms"]:
-        user["rooms"].append(room_name)
-        save_user(user_name, user)
+    logger.info("user joined room", extra={"user": user_name, "room": room_name})
     return jsonify({"success": f"User {user_name} joined room {room_name}"}), 200
 
 
@@ -96,28 +647,17 @@ def leave_room():
     if not user_name or not room_name:
         return jsonify({"error": "user-name and room-name are required to leave room"}), 400
 
-    user = get_user(user_name)
-    room = get_room(room_name)
-    if not user:
+    result = leave(user_name, room_name)
+    if result == -1:
         return jsonify({"error": f"User {user_name} does not exist"}), 400
 
-    if not room:
+    if result == -2:
         return jsonify({"error": f"Room {room_name} does not exist"}), 400
 
-    if room_name not in user["rooms"]:
+    if result == -3:
         return jsonify({"error": f"User {user_name} is not in room {room_name}"}), 400
 
-
-     # Remove user from room
-    if user_name in room["users"]:
-        room["users"].remove(user_name)
-        save_room(room_name, room)
-
-    # Remove room from user
-    if room_name in user["rooms"]:
-        user["rooms"].remove(room_name)
-        save_user(user_name, user)
-
+    logger.info("user left room", extra={"user": user_name, "room": room_name})
     return jsonify({"success": f"User {user_name} left room {room_name}"}), 200
 
 # Add a new message
@@ -131,29 +671,192 @@ def add_message():
     if not user_name or not room_name or not msg:
         return jsonify({"error": "user-name, room-name and message text are required to add message"}), 400
 
-    room = get_room(room_name)
-    if not room or user_name not in room["users"]:
+    message_id = send(user_name, room_name, msg)
+    if message_id is None:
         return jsonify({"error": "User not in room"}), 400
+    logger.info("message sent", extra={"user": user_name, "room": room_name, "id": message_id})
+    return jsonify({"success": "Message added", "id": message_id}), 200
 
-    message = {"user": user_name, "msg": msg}
-    room["messages"].append(message)
-    save_room(room_name, room)
-
-    return jsonify({"success": "Message added"}), 200
-
-# Get all the messages for a room
+# Get the messages of a room. The optional after and before fields are message ids and
+# only the messages with after < id < before are returned, at most limit of them: the
+# oldest ones when after is given, otherwise the newest ones before before.
 @app.route("/get-messages", methods=["POST"])
 def get_messages():
     data = request.json
     room_name = data.get('room-name')
     if not room_name:
         return jsonify({"error": "room-name is required to get messages"}), 400
-    print(f"> displaying messages in room {room_name}.")
-    room = get_room(room_name)
-    if not room:
+    try:
+        after = get_stream_id(data, 'after')
+        before = get_stream_id(data, 'before')
+    except ValueError as e:
+        return jsonify({"error": f"{e} must be a message id"}), 400
+    try:
+        limit = get_int_param(data, 'limit')
+    except ValueError as e:
+        return jsonify({"error": f"{e} must be a non-negative integer"}), 400
+    logger.debug("messages read", extra={"room": room_name})
+    if not room_exists(room_name):
         return jsonify({"error": "Room does not exist"}), 400
 
-    return jsonify({"success": room["messages"]}), 200
+    low = f"({after}" if after else "-"
+    high = f"({before}" if before else "+"
+    if before and not after and limit:
+        # Page back from before: the newest messages first, then put back in order
+        entries = redis.xrevrange(messages_key(room_name), high, low, count=limit)[::-1]
+    else:
+        entries = redis.xrange(messages_key(room_name), low, high, count=limit or None)
+    messages = [message_info(entry) for entry in entries]
+    return jsonify({
+        "success": [{"user": m["user"], "msg": m["msg"]} for m in messages],
+        "messages": messages,
+        # Cursors for the next poll (after=last-id) or the previous page (before=first-id)
+        "first-id": messages[0]["id"] if messages else None,
+        "last-id": messages[-1]["id"] if messages else after,
+    }), 200
+
+
+# Read the rooms to follow and their cursors from a /subscribe request.
+# The JSON body has "rooms": {"room-name": after, ...} (after may be null to only get new messages),
+# the query string has room=<name> repeated with optional matching after=<id> values.
+def get_subscription(data):
+    if data:
+        followed = data.get('rooms')
+        if isinstance(followed, list):
+            followed = {name: None for name in followed}
+        if not isinstance(followed, dict):
+            raise ValueError("rooms")
+        cursors = {}
+        for name, after in followed.items():
+            cursors[name] = get_stream_id({'after': after}, 'after')
+        return cursors
+    names = request.args.getlist('room')
+    afters = request.args.getlist('after')
+    cursors = {}
+    for i, name in enumerate(names):
+        cursors[name] = get_stream_id({'after': afters[i] if i < len(afters) else None}, 'after')
+    return cursors
+
+# Id of the newest message of a room, 0-0 if there is none
+def last_message_id(room_name):
+    entries = redis.xrevrange(messages_key(room_name), count=1)
+    return entries[0][0] if entries else "0-0"
+
+# Read the messages past the cursor of every followed room from the streams and advance the cursors
+def read_new_messages(cursors):
+    new_messages = {}
+    for name, after in cursors.items():
+        entries = redis.xrange(messages_key(name), f"({after}", "+", count=SUBSCRIBE_BATCH)
+        if entries:
+            new_messages[name] = [message_info(entry) for entry in entries]
+            cursors[name] = entries[-1][0]
+    return new_messages
+
+# Add the messages queued by the listener that are past the cursors and advance the cursors
+def add_queued_messages(new_messages, queued, cursors):
+    for name, m in queued:
+        if id_order(m["id"]) > id_order(cursors[name]):
+            new_messages.setdefault(name, []).append(m)
+            cursors[name] = m["id"]
+
+# Wait for new messages in one or more rooms.
+# By default this is a long-poll that returns as soon as there is something new in any of
+# the rooms or after the timeout, with the cursors to pass on the next call. With
+# "stream": true (or an Accept: text/event-stream header) the messages are pushed as
+# Server-Sent Events over the same connection until the client disconnects.
+# Messages sent through any server reach the subscribers of every server within
+# milliseconds through the listener, the streams are only read to catch up.
+@app.route("/subscribe", methods=["GET", "POST"])
+def subscribe():
+    data = request.get_json(silent=True) if request.method == "POST" else None
+    try:
+        cursors = get_subscription(data)
+        timeout = get_int_param(data or request.args, 'timeout')
+    except ValueError as e:
+        return jsonify({"error": f"{e} is not valid"}), 400
+    if not cursors:
+        return jsonify({"error": "rooms are required to subscribe"}), 400
+    timeout = SUBSCRIBE_TIMEOUT if timeout is None else min(timeout, SUBSCRIBE_MAX_TIMEOUT)
+    stream = (data or request.args).get('stream') in (True, "true", "1") or \
+        request.accept_mimetypes.best == "text/event-stream"
+
+    missing = [name for name in cursors if not room_exists(name)]
+    for name in missing:
+        del cursors[name]
+    if not cursors:
+        return jsonify({"error": "None of the rooms exist", "missing": missing}), 400
+
+    # Subscribe before reading the streams so nothing is missed in between
+    subscriber = Subscriber()
+    ready = [listener.add(name, subscriber) for name in cursors]
+
+    def unsubscribe_all():
+        for name in cursors:
+            listener.remove(name, subscriber)
+
+    try:
+        for event in ready:
+            if not event.wait(timeout):
+                unsubscribe_all()
+                return jsonify({"error": "Cannot subscribe to the rooms"}), 503
+        # Without a cursor only the messages sent from now on are returned
+        for name, after in cursors.items():
+            if after is None:
+                cursors[name] = last_message_id(name)
+    except BaseException:
+        unsubscribe_all()
+        raise
+    logger.info("client subscribed", extra={"rooms": list(cursors)})
+
+    if stream:
+        def events():
+            try:
+                yield "retry: 1000\n\n"
+                new_messages = read_new_messages(cursors)
+                while True:
+                    for name, msgs in new_messages.items():
+                        for m in msgs:
+                            yield f"event: message\nid: {m['id']}\ndata: {json.dumps(dict(m, room=name))}\n\n"
+                    # A full batch means more messages are already waiting
+                    if any(len(msgs) == SUBSCRIBE_BATCH for msgs in new_messages.values()):
+                        new_messages = read_new_messages(cursors)
+                        continue
+                    queued, resync = subscriber.wait(timeout)
+                    if resync:
+                        new_messages = read_new_messages(cursors)
+                    elif queued:
+                        new_messages = {}
+                        add_queued_messages(new_messages, queued, cursors)
+                    else:
+                        new_messages = {}
+                        # Keep the connection alive through proxies
+                        yield ": keep-alive\n\n"
+            finally:
+                unsubscribe_all()
+        return Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    try:
+        deadline = time.monotonic() + timeout
+        new_messages = read_new_messages(cursors)
+        while not new_messages:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            queued, resync = subscriber.wait(remaining)
+            if resync:
+                new_messages = read_new_messages(cursors)
+            else:
+                add_queued_messages(new_messages, queued, cursors)
+    finally:
+        unsubscribe_all()
+    return jsonify({
+        "success": {name: [m["user"] + ':\n' + m["msg"] for m in msgs] for name, msgs in new_messages.items()},
+        "messages": new_messages,
+        # Pass these back as the rooms of the next call
+        "cursors": cursors,
+        "missing": missing,
+    }), 200
 
 
 # Check if user can send message to a room
@@ -166,9 +869,8 @@ def can_send():
     if not user_name or not room_name:
         return jsonify({"error": "user-name and room-name are required to see if can send message"}), 400
 
-    room = get_room(room_name)
-    if not room or user_name not in room["users"]:
-        print(f"* User {user_name} cannot send message in room {room_name}")
+    if not is_member(user_name, room_name):
+        logger.warning("user cannot send message", extra={"user": user_name, "room": room_name})
         return jsonify({"error": f"User {user_name} cannot send message in room {room_name}"}), 400
     return jsonify({"success": f"User {user_name} can send message in room {room_name}"}), 200
 
@@ -0,0 +1,133 @@
+import importlib
+import os
+import shutil
+import subprocess
+import sys
+import threading
+import time
+
+import pytest
+import redis as Redis
+from redis.cluster import RedisCluster
+
+# Binary used to start the Redis Cluster the server is tested against
+REDIS_SERVER = os.environ.get("CHAT_TEST_REDIS_SERVER") or shutil.which("redis-server")
+# Ports of the 3 masters of the test cluster
+PORTS = [int(os.environ.get("CHAT_TEST_REDIS_PORT", 7101)) + i for i in range(3)]
+
+pytestmark = pytest.mark.skipif(REDIS_SERVER is None, reason="redis-server is needed to start a Redis Cluster")
+
+# Names that need the hash tag escaping, next to plain ones
+ROOM_NAMES = ["plain", "}first", "a{b}c", "}", "{", "100%", "%7D"]
+
+
+# Start 3 Redis servers in cluster mode, split the slots between them and join them
+@pytest.fixture(scope="module")
+def cluster(tmp_path_factory):
+    processes = []
+    for port in PORTS:
+        directory = tmp_path_factory.mktemp(f"redis{port}")
+        processes.append(subprocess.Popen(
+            [REDIS_SERVER, "--port", str(port), "--cluster-enabled", "yes", "--save", "", "--appendonly", "no",
+             "--dir", str(directory), "--cluster-config-file", "nodes.conf"],
+            stdout=subprocess.DEVNULL))
+    try:
+        nodes = [Redis.StrictRedis(port=port, decode_responses=True) for port in PORTS]
+        for node in nodes:
+            wait_until(lambda: ping(node))
+        step = 16384 // len(nodes) + 1
+        for i, node in enumerate(nodes):
+            node.execute_command("CLUSTER ADDSLOTS", *range(i * step, min((i + 1) * step, 16384)))
+            node.execute_command("CLUSTER MEET", "127.0.0.1", PORTS[0])
+        wait_until(lambda: all(node.cluster("info")["cluster_state"] == "ok" for node in nodes))
+        yield PORTS
+    finally:
+        for process in processes:
+            process.terminate()
+            process.wait()
+
+
+def ping(node):
+    try:
+        return node.ping()
+    except Redis.ConnectionError:
+        return False
+
+
+def wait_until(condition, timeout=20):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "timed out"
+        time.sleep(0.1)
+
+
+# The server module connected to the test cluster
+@pytest.fixture(scope="module")
+def server(cluster):
+    os.environ.update(CHAT_REDIS_HOST="127.0.0.1", CHAT_REDIS_PORT=str(cluster[0]), CHAT_REDIS_CLUSTER="1",
+                      CHAT_LOG_LEVEL="ERROR")
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    module = importlib.import_module("server")
+    assert isinstance(module.redis, RedisCluster)
+    return module
+
+
+@pytest.fixture(scope="module")
+def client(server):
+    client = server.app.test_client()
+    for name in ROOM_NAMES:
+        assert client.post("/create-room", json={"room-name": name}).status_code == 200
+    for name in ("alice", "}bob"):
+        assert client.post("/add-user", json={"user-name": name}).status_code == 200
+    return client
+
+
+# Every key of a room is in one slot, whatever the name
+def test_keys_share_a_slot(server):
+    for name in ROOM_NAMES + ["alice", "}bob"]:
+        keys = [server.room_key(name), server.members_key(name), server.messages_key(name)]
+        assert len({server.redis.keyslot(key) for key in keys}) == 1, name
+
+
+# The join, send and leave scripts run on the keys of one slot
+def test_scripts(client):
+    for user in ("alice", "}bob"):
+        for room in ROOM_NAMES:
+            body = {"user-name": user, "room-name": room}
+            assert client.post("/join-room", json=body).status_code == 200
+            assert client.post("/can-send", json=body).status_code == 200
+            assert client.post("/add-message", json=dict(body, message=f"{user} in {room}")).status_code == 200
+    for room in ROOM_NAMES:
+        reply = client.post("/get-messages", json={"room-name": room}).json
+        assert [m["msg"] for m in reply["messages"]] == [f"alice in {room}", f"}}bob in {room}"]
+        body = {"user-name": "}bob", "room-name": room}
+        assert client.post("/leave-room", json=body).status_code == 200
+        assert client.post("/leave-room", json=body).status_code == 400
+        assert client.post("/can-send", json=body).status_code == 400
+        assert client.post("/add-message", json=dict(body, message="gone")).status_code == 400
+        reply = client.post("/leave-room", json={"user-name": "nobody", "room-name": room})
+        assert reply.status_code == 400 and "does not exist" in reply.json["error"]
+        assert client.post("/join-room", json={"user-name": "nobody", "room-name": room}).status_code == 400
+        assert client.post("/create-room", json={"room-name": room}).status_code == 400
+
+
+# The directory sets are spread over the masters and listed together
+def test_directory_sharding(server, client):
+    nodes = {server.redis.get_node_from_key(server.directory_key(shard)).name
+             for shard in range(server.DIRECTORY_SHARDS)}
+    assert len(nodes) == 3
+    assert client.get("/get-rooms").json["rooms"] == sorted(ROOM_NAMES)
+
+
+# A message sent through the cluster reaches a waiting /subscribe through Pub/Sub, the same
+# as it is read back from the stream
+def test_subscribe(client):
+    room = "}first"
+    last_id = client.post("/get-messages", json={"room-name": room}).json["last-id"]
+    sender = threading.Timer(0.5, client.post, args=("/add-message",),
+                             kwargs={"json": {"user-name": "alice", "room-name": room, "message": "new"}})
+    sender.start()
+    reply = client.post("/subscribe", json={"rooms": {room: last_id}, "timeout": 10}).json
+    sender.join()
+    assert [m["msg"] for m in reply["messages"][room]] == ["new"]
+    assert reply["messages"][room] == client.post("/get-messages", json={"room-name": room, "after": last_id}).json["messages"]
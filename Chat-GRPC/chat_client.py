@@ -0,0 +1,98 @@
+import asyncio
+
+import grpc
+import chat_pb2
+import chat_pb2_grpc
+
+
+# Async client for the chat service, used by the CLI client and the load tools.
+# All the calls share one channel, so independent calls (one per room for example) can be
+# issued together with asyncio.gather and complete in about one round trip. At most
+# max_concurrency unary calls are in flight at once, the others wait for a free slot.
+class ChatClient:
+    def __init__(self, target="server:8080", max_concurrency=100):
+        self.channel = grpc.aio.insecure_channel(target)
+        self.stub = chat_pb2_grpc.ChatStub(self.channel)
+        self.limit = asyncio.Semaphore(max_concurrency)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        await self.channel.close()
+
+    # Make a unary call once a slot is free
+    async def call(self, rpc, request):
+        async with self.limit:
+            return await getattr(self.stub, rpc)(request)
+
+    async def create_room(self, room_name):
+        return (await self.call("CreateRoom", chat_pb2.Room(name=room_name))).flag
+
+    async def remove_room(self, room_name):
+        return (await self.call("RemoveRoom", chat_pb2.Room(name=room_name))).flag
+
+    # Limit the history of a room to max_count messages, max_age seconds and max_bytes,
+    # the limits left at 0 are the server's
+    async def set_retention(self, room_name, max_count=0, max_age=0, max_bytes=0):
+        retention = chat_pb2.Retention(max_count=max_count, max_age=max_age, max_bytes=max_bytes)
+        return (await self.call("SetRetention", chat_pb2.Room(name=room_name, retention=retention))).flag
+
+    # The room list as text, the rooms the user joined are marked
+    async def get_rooms(self, user_name):
+        return (await self.call("GetRooms", chat_pb2.User(name=user_name))).text
+
+    # A page of the rooms whose name starts with prefix as a RoomPage, each marked if the user joined it
+    async def list_rooms(self, user_name, prefix="", page_token="", limit=0):
+        query = chat_pb2.RoomQuery(user=user_name, prefix=prefix, page_token=page_token, limit=limit)
+        return await self.call("ListRooms", query)
+
+    async def add_user(self, user_name):
+        return (await self.call("AddUser", chat_pb2.User(name=user_name))).flag
+
+    async def remove_user(self, user_name):
+        return (await self.call("RemoveUser", chat_pb2.User(name=user_name))).flag
+
+    async def join_room(self, user_name, room_name):
+        return (await self.call("JoinRoom", chat_pb2.UserRoom(user=user_name, room=room_name))).flag
+
+    async def leave_room(self, user_name, room_name):
+        return (await self.call("LeaveRoom", chat_pb2.UserRoom(user=user_name, room=room_name))).flag
+
+    async def add_message(self, user_name, room_name, msg):
+        return (await self.call("AddMessage", chat_pb2.UserRoomMessage(user=user_name, room=room_name, msg=msg))).flag
+
+    async def can_send(self, user_name, room_name):
+        return (await self.call("CanSend", chat_pb2.UserRoom(user=user_name, room=room_name))).flag
+
+    # A page of the history of a room as a Messages reply
+    async def get_messages(self, room_name, since_id=0, limit=0, page_token=""):
+        query = chat_pb2.MessageQuery(name=room_name, since_id=since_id, limit=limit, page_token=page_token)
+        return await self.call("GetMessages", query)
+
+    # The batch calls return the status of each room, in the order of the rooms given
+
+    async def create_rooms(self, room_names):
+        return (await self.call("CreateRooms", chat_pb2.Rooms(names=room_names))).statuses
+
+    async def join_rooms(self, user_name, room_names):
+        return (await self.call("JoinRooms", chat_pb2.UserRooms(user=user_name, rooms=room_names))).statuses
+
+    async def leave_rooms(self, user_name, room_names):
+        return (await self.call("LeaveRooms", chat_pb2.UserRooms(user=user_name, rooms=room_names))).statuses
+
+    async def broadcast_message(self, user_name, room_names, msg, all_or_none=False):
+        request = chat_pb2.UserRoomsMessage(user=user_name, rooms=room_names, msg=msg, all_or_none=all_or_none)
+        return (await self.call("BroadcastMessage", request)).statuses
+
+    # Iterate over the new messages of the rooms. Streams do not count against the limit.
+    def subscribe(self, room_names, after=None):
+        return self.stub.Subscribe(chat_pb2.Subscription(rooms=room_names, after=after or {}))
+
+    # Open a session, commands is an async iterator of Command and the call is iterated
+    # for the Events
+    def session(self, commands):
+        return self.stub.Session(commands)
@@ -1,9 +1,9 @@
 import asyncio
 import logging
+import signal
 
 import grpc
-import chat_pb2
-import chat_pb2_grpc
+from chat_client import ChatClient
 
 # Client class
 class Client:
@@ -11,8 +11,8 @@ class Client:
         # Username of the current client
         self.user_name = ''
 
-        # The stub function for gRPC
-        self.stub:chat_pb2_grpc.ChatStub = None
+        # The async gRPC client
+        self.chat:ChatClient = None
 
         # The current command
         self.command = None
@@ -21,7 +21,7 @@ class Client:
         self.args = []
 
     # Gets a command from the user and sends it to the server using gRPC
-    def get_command(self):
+    async def get_command(self):
         self.command:str = input("> Enter command ('help' for list of commands): ")
         self.args = self.command.split()
         if self.command == "help":
@@ -32,12 +32,14 @@ class Client:
             print("  join <chatroom1> [chatroom2 chatroom3 ...]\n")
             print("*Leave previously joined chatrooms:")
             print("  leave <chatroom1> [chatroom2 chatroom3 ...]\n")
-            print("*List all the names of existing chatrooms:")
-            print("  list\n")
+            print("*List the names of existing chatrooms, or the ones starting with a prefix:")
+            print("  list [prefix]\n")
             print("*Display the messages in a single chatroom:")
             print("  display <chatroom1>\n")
             print("*Send a message to one or multiple chatrooms:")
             print("  send <chatroom1> [chatroom2 chatroom3 ...]\n")
+            print("*Display the new messages of chatrooms as they arrive (Ctrl-C to stop):")
+            print("  follow <chatroom1> [chatroom2 chatroom3 ...]\n")
             print("*Show this help text:")
             print("  help\n")
             print("*Quit:")
@@ -49,16 +51,22 @@ class Client:
             if (self.args[0] == "send" or
                 self.args[0] == "join" or
                 self.args[0] == "leave" or
-                self.args[0] == "create"
+                self.args[0] == "create" or
+                self.args[0] == "follow"
             ):
                 if len(self.args) < 2:
                     print("> This command needs at least one argument")
                     return
-            elif self.args[0] == "help" or self.args[0] == "list":
+            elif self.args[0] == "help":
                 if len(self.args) > 1:
                     print("> This command takes no argument.")
                     return
 
+            elif self.args[0] == "list":
+                if len(self.args) > 2:
+                    print("> This command takes at most 1 argument.")
+                    return
+
             elif self.args[0] == "display":
                 if len(self.args) != 2:
                     print("> This command takes only 1 arguments.")
@@ -66,51 +74,65 @@ class Client:
 
 
             if self.args[0] == "create":
-                for arg in self.args[1:]:
-                    result = self.stub.CreateRoom(chat_pb2.Room(name=arg))
+                results = await self.chat.create_rooms(self.args[1:])
+                for arg, result in zip(self.args[1:], results):
                     if result.flag == True:
                         print("> Chatroom " + arg+ " created.")
                     else:
                         print("* Error creating chatroom " + arg + ".")
 
             elif self.args[0] == "join":
-                for arg in self.args[1:]:
-                    result = self.stub.JoinRoom(chat_pb2.UserRoom(user=self.user_name, room=arg))
+                results = await self.chat.join_rooms(self.user_name, self.args[1:])
+                for arg, result in zip(self.args[1:], results):
                     if result.flag == True:
                         print("> You joined chatroom " + arg + ".")
                     else:
                         print("* Error joining chatroom " + arg + ".")
 
             elif self.args[0] == "leave":
-                for arg in self.args[1:]:
-                    result = self.stub.LeaveRoom(chat_pb2.UserRoom(user=self.user_name, room=arg))
+                results = await self.chat.leave_rooms(self.user_name, self.args[1:])
+                for arg, result in zip(self.args[1:], results):
                     if result.flag == True:
                         print("> You left chatroom " + arg + ".")
                     else:
                         print("* Error leaving chatroom " + arg + ".")
 
             elif self.args[0] == "send":
-                self.add_message()
+                await self.add_message()
 
             elif self.args[0] == "list":
-                rooms = self.stub.GetRooms(chat_pb2.User(name=self.user_name))
-                if rooms.text == '':
+                prefix = self.args[1] if len(self.args) > 1 else ''
+                page = await self.chat.list_rooms(self.user_name, prefix)
+                if len(page.rooms) == 0:
                     print("> [There are no rooms]")
                     return
                 print("> List of rooms:")
-                print(rooms.text)
+                # Fetch the list page by page
+                while True:
+                    for room in page.rooms:
+                        print('\t' + room.name + (' [joined]' if room.joined else ''))
+                    if page.next_page_token == '':
+                        break
+                    page = await self.chat.list_rooms(self.user_name, prefix, page.next_page_token)
 
             elif self.args[0] == "display":
-                messages = self.stub.GetMessages(chat_pb2.Room(name=self.args[1]))
-                if messages.text == None:
+                messages = await self.chat.get_messages(self.args[1])
+                if messages.found == False:
                     print("> Room " + self.args[1] + " does not exist.")
                     return
-                elif messages.text == []:
+                elif messages.last_id == 0:
                     print("> [There are no messages]")
                     return
-                else:
-                    for m in messages.text:
-                        print(m)
+                # Fetch the history page by page
+                while True:
+                    for m in messages.messages:
+                        print(m.user + ':\n' + m.msg)
+                    if messages.next_page_token == '':
+                        break
+                    messages = await self.chat.get_messages(self.args[1], page_token=messages.next_page_token)
+
+            elif self.args[0] == "follow":
+                await self.follow()
 
             elif self.args[0] == "quit":
                 return
@@ -120,14 +142,7 @@ class Client:
 
 
     # For adding a new message to the chatroom
-    def add_message(self):
-        # Check if we can send message to all the rooms given in the command args
-        for arg in self.args[1:]:
-            result = self.stub.CanSend(chat_pb2.UserRoom(user=self.user_name, room=arg))
-            if result.flag == False:
-                print("> You can't send message to this room.")
-                return
-
+    async def add_message(self):
         # Get the text line by line
         text = ''
         line:str = input("> Enter your message (Enter an empty line to send): ")
@@ -135,37 +150,69 @@ class Client:
             text += '\t' + line + '\n'
             line = input('>>> ')
 
-        # Send to the server
-        for arg in self.args[1:]:
-            result = self.stub.AddMessage(chat_pb2.UserRoomMessage(user=self.user_name, room=arg, msg=text))
+        # Send to the server, only if we can send message to all the rooms given in the command args
+        results = await self.chat.broadcast_message(self.user_name, self.args[1:], text, all_or_none=True)
+        if not any(result.flag for result in results):
+            print("> You can't send message to this room.")
+            return
+        for arg, result in zip(self.args[1:], results):
             if result.flag == True:
                 print("> Sent to " + arg)
             else:
                 print("> Unable to send to " + arg)
 
 
+    # Print the new messages of the rooms as they arrive until Ctrl-C is pressed
+    async def follow(self):
+        # Id of the last message received from each room, to subscribe again from there
+        after = {}
+        print("> Following " + ", ".join(self.args[1:]) + ". Press Ctrl-C to stop.")
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                stream = self.chat.subscribe(self.args[1:], after)
+                # Ctrl-C only ends the stream
+                loop.add_signal_handler(signal.SIGINT, stream.cancel)
+                try:
+                    async for m in stream:
+                        after[m.room] = m.id
+                        print("[" + m.room + "] " + m.user + ":\n" + m.msg)
+                except asyncio.CancelledError:
+                    return
+                except grpc.RpcError as e:
+                    # The server dropped us for reading too slowly
+                    if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                        continue
+                    print("* " + e.details())
+                    return
+                print("> The rooms were removed.")
+                return
+        finally:
+            loop.remove_signal_handler(signal.SIGINT)
+
+
     # Sign up a new client with a username
-    def sign_up(self):
+    async def sign_up(self):
         self.user_name = input("> Welcome to NetChat. Enter a unique username: ")
-        if self.user_name != '':
-            result = self.stub.AddUser(chat_pb2.User(name=self.user_name))
-        return result.flag
+        if self.user_name == '':
+            return False
+        return await self.chat.add_user(self.user_name)
 
 
-    # Run the gRPC client
-    def run(self) -> None:
+    # Run the gRPC client. Reading the input blocks the event loop, which has nothing
+    # else to do meanwhile.
+    async def run(self) -> None:
         # Connect to the server
-        with grpc.insecure_channel("server:8080") as channel:
-            self.stub = chat_pb2_grpc.ChatStub(channel)
+        async with ChatClient("server:8080") as self.chat:
 
             # Sign up as much as unique name is entered as username
             success = False
             while (not success):
-                success = self.sign_up()
+                success = await self.sign_up()
 
             # Infinitely get the command from the user and send it to server unless the user types quit.
             while True:
-                self.get_command()
+                await self.get_command()
                 if self.args != None and len(self.args) > 0 and self.args[0] != "quit": continue
                 break
 
@@ -173,4 +220,4 @@ class Client:
 if __name__ == "__main__":
     logging.basicConfig()
     c = Client()
-    c.run()
+    asyncio.run(c.run())
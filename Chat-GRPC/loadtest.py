@@ -0,0 +1,254 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+
+import grpc
+from chat_client import ChatClient
+
+
+# Operations run by the virtual users and their default weights
+MIX = "create=1,join=4,send=10,read=5"
+
+# Results of the previous runs, one JSON object per run
+HISTORY = "loadtest-history.json"
+
+
+def parse_mix(text):
+    mix = {}
+    for part in text.split(","):
+        op, _, weight = part.partition("=")
+        if op not in ("create", "join", "send", "read"):
+            raise SystemExit(f"unknown operation {op!r} in the mix")
+        mix[op] = float(weight or 1)
+    return mix
+
+
+# Value at quantile q of a sorted list
+def percentile(values, q):
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+# Latencies and outcomes of every operation of a run. An operation is rejected when the
+# server answers with a false flag (the room already exists, the user is not a member...)
+# and fails when the call itself fails.
+class Results:
+    def __init__(self):
+        self.latencies = {}
+        self.rejected = {}
+        self.errors = {}
+
+    def add(self, op, seconds, ok):
+        self.latencies.setdefault(op, []).append(seconds)
+        if not ok:
+            self.rejected[op] = self.rejected.get(op, 0) + 1
+
+    def error(self, op, seconds, code):
+        self.latencies.setdefault(op, []).append(seconds)
+        key = f"{op}:{code}"
+        self.errors[key] = self.errors.get(key, 0) + 1
+
+    def summary(self, elapsed):
+        ops = {}
+        everything = []
+        for op, latencies in sorted(self.latencies.items()):
+            latencies.sort()
+            everything.extend(latencies)
+            ops[op] = summarize(latencies, elapsed)
+            ops[op]["rejected"] = self.rejected.get(op, 0)
+        everything.sort()
+        return {"elapsed": elapsed, "total": summarize(everything, elapsed), "ops": ops, "errors": self.errors}
+
+
+def summarize(latencies, elapsed):
+    return {"count": len(latencies),
+            "throughput": len(latencies) / elapsed if elapsed else 0.0,
+            "p50_ms": percentile(latencies, 0.5) * 1e3,
+            "p90_ms": percentile(latencies, 0.9) * 1e3,
+            "p99_ms": percentile(latencies, 0.99) * 1e3,
+            "max_ms": (latencies[-1] if latencies else 0.0) * 1e3}
+
+
+# A simulated user and the rooms it joined
+class VirtualUser:
+    def __init__(self, name, client):
+        self.name = name
+        self.client = client
+        self.joined = []
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.args = args
+        self.mix = parse_mix(args.mix)
+        self.prefix = f"load{os.getpid()}-{int(time.time())}"
+        self.clients = [ChatClient(args.target, args.max_concurrency) for _ in range(args.connections)]
+        self.rooms = [f"{self.prefix}-room{i}" for i in range(args.rooms)]
+        self.users = [VirtualUser(f"{self.prefix}-user{i}", self.clients[i % len(self.clients)])
+                      for i in range(args.users)]
+        self.created = 0
+        self.results = Results()
+        self.random = random.Random(args.seed)
+
+    # Create the rooms and the users, each user joins one room so it can send right away
+    async def setup(self):
+        client = self.clients[0]
+        for i in range(0, len(self.rooms), 500):
+            await client.create_rooms(self.rooms[i:i + 500])
+        await asyncio.gather(*(user.client.add_user(user.name) for user in self.users))
+        for user in self.users:
+            user.joined.append(self.random.choice(self.rooms))
+        await asyncio.gather(*(user.client.join_room(user.name, user.joined[0]) for user in self.users))
+
+    def pick(self):
+        return self.random.choices(list(self.mix), weights=list(self.mix.values()))[0]
+
+    async def create(self, user):
+        self.created += 1
+        room = f"{self.prefix}-new{self.created}"
+        ok = await user.client.create_room(room)
+        if ok:
+            self.rooms.append(room)
+        return ok
+
+    async def join(self, user):
+        room = self.random.choice(self.rooms)
+        ok = await user.client.join_room(user.name, room)
+        if ok and room not in user.joined:
+            user.joined.append(room)
+        return ok
+
+    async def send(self, user):
+        room = self.random.choice(user.joined)
+        return await user.client.add_message(user.name, room, "load test message")
+
+    async def read(self, user):
+        room = self.random.choice(user.joined)
+        return (await user.client.get_messages(room, limit=self.args.page_size)).found
+
+    # Run one operation, start is when it was due so the time spent waiting for a free
+    # slot is counted in its latency
+    async def run_op(self, user, op, start):
+        try:
+            ok = await getattr(self, op)(user)
+        except grpc.aio.AioRpcError as e:
+            self.results.error(op, time.perf_counter() - start, e.code().name)
+        else:
+            self.results.add(op, time.perf_counter() - start, ok)
+
+    # Closed loop: every user waits for its operation to complete, then thinks before the next one
+    async def closed_loop(self, deadline):
+        async def run_user(user):
+            while time.perf_counter() < deadline:
+                await self.run_op(user, self.pick(), time.perf_counter())
+                if self.args.think:
+                    await asyncio.sleep(self.random.expovariate(1 / self.args.think))
+        await asyncio.gather(*(run_user(user) for user in self.users))
+
+    # Open loop: operations arrive at the given rate whether or not the earlier ones completed
+    async def open_loop(self, deadline):
+        tasks = set()
+        due = time.perf_counter()
+        while due < deadline:
+            delay = due - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(self.run_op(self.random.choice(self.users), self.pick(), due))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            due += self.random.expovariate(self.args.rate)
+        if tasks:
+            await asyncio.wait(tasks)
+
+    async def run(self):
+        try:
+            await self.setup()
+            start = time.perf_counter()
+            deadline = start + self.args.duration
+            if self.args.mode == "open":
+                await self.open_loop(deadline)
+            else:
+                await self.closed_loop(deadline)
+            return self.results.summary(time.perf_counter() - start)
+        finally:
+            await asyncio.gather(*(client.close() for client in self.clients))
+
+
+# The channels are bound to the event loop they are created in
+async def run(args):
+    return await LoadTest(args).run()
+
+
+def report(summary):
+    print("operation".ljust(10) + "".join(h.rjust(10) for h in
+          ("count", "ops/s", "p50 ms", "p90 ms", "p99 ms", "max ms", "rejected")))
+    rows = list(summary["ops"].items()) + [("total", summary["total"])]
+    for op, s in rows:
+        print(op.ljust(10) + f"{s['count']:10d}{s['throughput']:10.1f}{s['p50_ms']:10.2f}{s['p90_ms']:10.2f}"
+              f"{s['p99_ms']:10.2f}{s['max_ms']:10.2f}" + str(s.get("rejected", "")).rjust(10))
+    for error, count in sorted(summary["errors"].items()):
+        print(f"* {count} calls failed with {error}")
+
+
+# The runs recorded in the history file, oldest first
+def load_history(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return []
+
+
+# Append the run to the history and compare it with the last run of the same configuration
+def record(path, label, config, summary):
+    history = load_history(path)
+    previous = [run for run in history if run["config"] == config]
+    if previous:
+        last = previous[-1]["summary"]["total"]
+        total = summary["total"]
+        print(f"> Compared to {previous[-1]['time']}: throughput {change(last['throughput'], total['throughput'])}, "
+              f"p50 {change(last['p50_ms'], total['p50_ms'])}, p99 {change(last['p99_ms'], total['p99_ms'])}")
+    history.append({"time": time.strftime("%Y-%m-%dT%H:%M:%S"), "label": label, "config": config, "summary": summary})
+    with open(path + ".tmp", "w") as f:
+        json.dump(history, f, indent=1)
+    os.replace(path + ".tmp", path)
+
+
+def change(before, after):
+    if not before:
+        return "n/a"
+    return f"{(after - before) / before * 100:+.1f}%"
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load generator for the gRPC chat server")
+    parser.add_argument("--target", default="localhost:8080")
+    parser.add_argument("--users", type=int, default=1000, help="number of virtual users")
+    parser.add_argument("--rooms", type=int, default=100, help="number of rooms created before the run")
+    parser.add_argument("--duration", type=float, default=30, help="length of the run in seconds")
+    parser.add_argument("--mix", default=MIX, help="weights of the operations, e.g. %(default)s")
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--think", type=float, default=1.0,
+                        help="closed loop: mean think time of a user between two operations in seconds")
+    parser.add_argument("--rate", type=float, default=1000, help="open loop: operations per second")
+    parser.add_argument("--connections", type=int, default=4, help="number of channels to the server")
+    parser.add_argument("--max-concurrency", type=int, default=100, help="calls in flight per channel")
+    parser.add_argument("--page-size", type=int, default=50, help="messages read by a read operation")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--history", default=HISTORY, help="JSON file the results are appended to, empty to skip")
+    parser.add_argument("--label", default="", help="label stored with the results")
+    args = parser.parse_args()
+
+    summary = asyncio.run(run(args))
+    report(summary)
+    if args.history:
+        config = {k: v for k, v in vars(args).items() if k not in ("target", "history", "seed", "label")}
+        record(args.history, args.label, config, summary)
+
+
+if __name__ == "__main__":
+    main()
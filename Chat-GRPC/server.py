@@ -1,19 +1,491 @@
 import asyncio
+import atexit
+import bisect
+import contextvars
+import itertools
+import json
 import logging
+import logging.handlers
+import multiprocessing
+import os
+import queue
+import random
+import signal
+import sys
+import time
+import uuid
+import zlib
+from array import array
 
 import grpc
 import chat_pb2
 import chat_pb2_grpc
 
 
+# Port of the HTTP endpoint serving the metrics, 0 to disable it
+METRICS_PORT = int(os.environ.get("CHAT_METRICS_PORT", 8081))
+# Metadata key carrying the trace id of a call. Calls without one get a new id when
+# CHAT_TRACE is 1, otherwise only the ids sent by the clients are used.
+TRACE_HEADER = "x-trace-id"
+TRACE = os.environ.get("CHAT_TRACE", "0") == "1"
+# Number of messages queued for a subscriber before it is dropped as too slow
+SUBSCRIBER_QUEUE_SIZE = int(os.environ.get("CHAT_SUBSCRIBER_QUEUE_SIZE", 256))
+# Number of worker processes. With more than one, the rooms and the users are split
+# between the workers, which all listen on the public port and forward the calls for
+# the rooms they do not own to the owner over its internal port (CHAT_SHARD_PORT + shard).
+WORKERS = int(os.environ.get("CHAT_WORKERS", 1))
+SHARD_PORT = int(os.environ.get("CHAT_SHARD_PORT", 9000))
+# Seconds between the checks of a worker that the process that started it is still running
+PARENT_CHECK_INTERVAL = 1
+# Default and maximum number of messages returned by GetMessages
+PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+# Default number of rooms returned by ListRooms, up to MAX_PAGE_SIZE
+ROOM_PAGE_SIZE = 50
+# Server-wide limits on the history of each room (0 for no limit): number of messages,
+# age in seconds and encoded size in bytes. Rooms can set their own with CreateRoom or
+# SetRetention. The oldest messages are removed by a background task that checks the
+# rooms every CHAT_COMPACTION_INTERVAL seconds.
+RETENTION_COUNT = int(os.environ.get("CHAT_RETENTION_COUNT", 0))
+RETENTION_AGE = float(os.environ.get("CHAT_RETENTION_AGE", 0))
+RETENTION_BYTES = int(os.environ.get("CHAT_RETENTION_BYTES", 0))
+COMPACTION_INTERVAL = float(os.environ.get("CHAT_COMPACTION_INTERVAL", 1))
+# Time the compaction task runs before letting the RPCs run, and number of messages of a
+# room it copies at a time when it frees the space of the removed ones
+COMPACTION_SLICE = 0.002
+COMPACTION_CHUNK = 16384
+
+# Minimum level of the log records written, and the fraction of the records below WARNING
+# that are kept (1 keeps them all, 0.01 one in a hundred)
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("CHAT_LOG_SAMPLE_RATE", 1))
+
+# Upper bounds in seconds of the buckets of the call latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# Attributes every log record has, the other ones are the fields passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+# Write each log record as one JSON object holding the event and its fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname, "event": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger("chat")
+
+# The RPCs only put the records in a queue, a background thread formats and writes
+# them so a slow stdout does not block the event loop. Below WARNING only a
+# LOG_SAMPLE_RATE fraction of the records is kept.
+def setup_logging():
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if LOG_SAMPLE_RATE < 1:
+        handler.addFilter(lambda record: record.levelno >= logging.WARNING or random.random() < LOG_SAMPLE_RATE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    logger.addHandler(handler)
+    logger.addFilter(TraceFilter())
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+# Per RPC method: call counts by status code, calls in flight, request and response
+# bytes and latency histograms, exported in the Prometheus text format. Everything runs
+# on the event loop of the process, so nothing is locked.
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        # [counts per bucket of LATENCY_BUCKETS and one for slower calls, total seconds] by method
+        self.latencies = {}
+        self.calls = {}
+        self.in_flight = {}
+        self.request_bytes = {}
+        self.response_bytes = {}
+        # Values set by the server itself, by name: (type, value)
+        self.values = {}
+
+    def set(self, name, value, kind="gauge"):
+        self.values[name] = (kind, value)
+
+    def start(self, method):
+        self.in_flight[method] = self.in_flight.get(method, 0) + 1
+
+    def observe(self, method, code, seconds, request_bytes, response_bytes):
+        self.in_flight[method] -= 1
+        key = (method, code)
+        self.calls[key] = self.calls.get(key, 0) + 1
+        self.request_bytes[method] = self.request_bytes.get(method, 0) + request_bytes
+        self.response_bytes[method] = self.response_bytes.get(method, 0) + response_bytes
+        histogram = self.latencies.get(method)
+        if histogram is None:
+            histogram = self.latencies[method] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+        histogram[0][bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        histogram[1] += seconds
+
+    def render(self):
+        lines = []
+        for name, (kind, value) in sorted(self.values.items()):
+            lines.append(f"# TYPE {self.prefix}_{name} {kind}")
+            lines.append(f"{self.prefix}_{name} {value}")
+        name = self.prefix + "_calls_total"
+        lines.append(f"# TYPE {name} counter")
+        errors = {}
+        for (method, code), count in sorted(self.calls.items()):
+            lines.append(f'{name}{{method="{method}",code="{code}"}} {count}')
+            if code != "OK":
+                errors[method] = errors.get(method, 0) + count
+        name = self.prefix + "_errors_total"
+        lines.append(f"# TYPE {name} counter")
+        for method, count in sorted(errors.items()):
+            lines.append(f'{name}{{method="{method}"}} {count}')
+        for suffix, kind, values in (("_in_flight", "gauge", self.in_flight),
+                                     ("_request_bytes_total", "counter", self.request_bytes),
+                                     ("_response_bytes_total", "counter", self.response_bytes)):
+            name = self.prefix + suffix
+            lines.append(f"# TYPE {name} {kind}")
+            for method, value in sorted(values.items()):
+                lines.append(f'{name}{{method="{method}"}} {value}')
+        name = self.prefix + "_call_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        quantiles = []
+        for method, (counts, total) in sorted(self.latencies.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{method="{method}"}} {total}')
+            lines.append(f'{name}_count{{method="{method}"}} {cumulative}')
+            for q in (0.5, 0.9, 0.99):
+                quantiles.append(f'{name}_quantile{{method="{method}",quantile="{q}"}} '
+                                 f'{quantile(counts, q):.6f}')
+        lines.append(f"# TYPE {name}_quantile gauge")
+        lines.extend(quantiles)
+        return "\n".join(lines) + "\n"
+
+# Estimate a quantile from the counts of a latency histogram by interpolating inside the
+# bucket it falls in
+def quantile(counts, q):
+    rank = q * sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            high = LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return 0.0
+
+metrics = Metrics("chat")
+
+# Trace id of the call being handled, added to its log records
+trace_id = contextvars.ContextVar("trace_id", default=None)
+
+class TraceFilter(logging.Filter):
+    def filter(self, record):
+        current = trace_id.get()
+        if current != None:
+            record.trace_id = current
+        return True
+
+# Metadata passing the trace id of the current call on to the calls it makes
+def trace_metadata():
+    current = trace_id.get()
+    return ((TRACE_HEADER, current),) if current != None else ()
+
+# Status code of a finished call
+def call_code(context, error):
+    if isinstance(error, asyncio.CancelledError):
+        return "CANCELLED"
+    code = context.code()
+    if code != None:
+        return code.name
+    return "UNKNOWN" if error != None else "OK"
+
+# Wraps the handler of every call to record its metrics and set its trace id, which is
+# sent back to the client in the trailing metadata
+class MetricsInterceptor(grpc.aio.ServerInterceptor):
+    async def intercept_service(self, continuation, handler_call_details):
+        handler = await continuation(handler_call_details)
+        if handler == None:
+            return None
+        method = handler_call_details.method.rsplit("/", 1)[-1]
+        trace = dict(handler_call_details.invocation_metadata or ()).get(TRACE_HEADER)
+        if trace == None and TRACE:
+            trace = uuid.uuid4().hex
+        args = {"request_deserializer": handler.request_deserializer,
+                "response_serializer": handler.response_serializer}
+        if handler.unary_unary:
+            return grpc.unary_unary_rpc_method_handler(self.unary(method, trace, handler.unary_unary), **args)
+        if handler.unary_stream:
+            return grpc.unary_stream_rpc_method_handler(self.stream(method, trace, handler.unary_stream, False), **args)
+        if handler.stream_unary:
+            return grpc.stream_unary_rpc_method_handler(self.unary(method, trace, handler.stream_unary, True), **args)
+        return grpc.stream_stream_rpc_method_handler(self.stream(method, trace, handler.stream_stream, True), **args)
+
+    def unary(self, method, trace, behavior, request_streaming=False):
+        async def wrapper(request, context):
+            sizes = [0, 0]
+            if request_streaming:
+                request = count_requests(request, sizes)
+            else:
+                sizes[0] = request.ByteSize()
+            begin(context, method, trace)
+            start = time.perf_counter()
+            error = None
+            try:
+                reply = await behavior(request, context)
+                sizes[1] = reply.ByteSize()
+                return reply
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                metrics.observe(method, call_code(context, error), time.perf_counter() - start, *sizes)
+        return wrapper
+
+    def stream(self, method, trace, behavior, request_streaming):
+        async def wrapper(request, context):
+            sizes = [0, 0]
+            if request_streaming:
+                request = count_requests(request, sizes)
+            else:
+                sizes[0] = request.ByteSize()
+            begin(context, method, trace)
+            start = time.perf_counter()
+            error = None
+            try:
+                async for reply in behavior(request, context):
+                    sizes[1] += reply.ByteSize()
+                    yield reply
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                metrics.observe(method, call_code(context, error), time.perf_counter() - start, *sizes)
+        return wrapper
+
+def begin(context, method, trace):
+    metrics.start(method)
+    if trace != None:
+        trace_id.set(trace)
+        context.set_trailing_metadata(((TRACE_HEADER, trace),))
+
+# Count the bytes of the requests of a client stream as they are read
+async def count_requests(requests, sizes):
+    async for request in requests:
+        sizes[0] += request.ByteSize()
+        yield request
+
+# Answer GET /metrics with the current metrics, any other request with 404
+async def handle_metrics(reader, writer):
+    try:
+        request_line = await reader.readline()
+        while (await reader.readline()).strip():
+            pass
+        if request_line.split()[:2] == [b"GET", b"/metrics"]:
+            status, body = "200 OK", metrics.render().encode()
+        else:
+            status, body = "404 Not Found", b""
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+        await writer.drain()
+    except (ConnectionError, IndexError):
+        pass
+    finally:
+        writer.close()
+
+
+# Compact storage for the messages of a room.
+# Each message is kept once, encoded as a one-message Messages reply in a shared buffer,
+# with the end offset of its encoding and its timestamp in typed arrays. Encoded protobuf
+# messages can be concatenated, so the reply for a page is parsed from one slice of the
+# buffer instead of being built field by field, and a single message is parsed from its own
+# slice when it is read.
+# Messages are read by index, the index of a message is its id minus one. trim() removes
+# the oldest messages right away by moving start, and compact() frees their space later
+# by copying the rest to smaller arrays, so a trim costs nothing and the copy is only made
+# once the removed messages take as much room as the ones left.
+class MessageColumns:
+    __slots__ = ("timestamps", "offsets", "encoded", "base", "start")
+
+    def __init__(self):
+        self.timestamps = array("d")
+        # offsets[i] and offsets[i + 1] delimit the encoding of message i. The offsets count
+        # from the first message ever added, offsets[0] is where the buffer starts.
+        self.offsets = array("Q", [0])
+        self.encoded = bytearray()
+        # Index of the message in the first slot of the arrays
+        self.base = 0
+        # Slot of the oldest message kept
+        self.start = 0
+
+    # Number of messages kept
+    def __len__(self):
+        return len(self.timestamps) - self.start
+
+    # Index of the oldest message kept, the number of messages removed
+    def first(self):
+        return self.base + self.start
+
+    # Number of messages ever added, the id of the newest one
+    def last(self):
+        return self.base + len(self.timestamps)
+
+    def append(self, user_name, msg, timestamp):
+        message = chat_pb2.Message(id=self.last() + 1, user=user_name, msg=msg, timestamp=timestamp)
+        self.encoded += chat_pb2.Messages(messages=[message]).SerializeToString()
+        self.timestamps.append(timestamp)
+        self.offsets.append(self.offsets[0] + len(self.encoded))
+
+    # Get the messages at indexes start to end - 1 as a Messages reply
+    def page(self, start, end):
+        base = self.offsets[0]
+        start = self.offsets[start - self.base] - base
+        end = self.offsets[end - self.base] - base
+        return chat_pb2.Messages.FromString(self.encoded[start:end])
+
+    # Get the message at index i
+    def get(self, i):
+        message = self.page(i, i + 1).messages[0]
+        return Message(message.user, message.msg, message.timestamp)
+
+    def __iter__(self):
+        for i in range(self.first(), self.last()):
+            yield self.get(i)
+
+    # Encoded size of the messages kept
+    def size(self):
+        return self.offsets[-1] - self.offsets[self.start]
+
+    # Memory held by the arrays and the buffer, including the messages not compacted yet
+    def nbytes(self):
+        arrays = (self.timestamps, self.offsets)
+        return sum(len(a) * a.itemsize for a in arrays) + len(self.encoded)
+
+    # Number of messages to remove so that at most count are kept, none are older than
+    # oldest and their encoded size is at most size. 0 means no limit.
+    def excess(self, count, oldest, size):
+        end = len(self.timestamps)
+        remove = 0
+        if count:
+            remove = max(remove, end - self.start - count)
+        if oldest:
+            remove = max(remove, bisect.bisect_left(self.timestamps, oldest, self.start, end) - self.start)
+        if size:
+            first = bisect.bisect_left(self.offsets, self.offsets[-1] - size, self.start, end)
+            remove = max(remove, first - self.start)
+        return remove
+
+    # Remove the oldest count messages
+    def trim(self, count):
+        self.start += count
+
+    # Free the space of the removed messages if they take as much room as the ones left.
+    # The messages kept are copied COMPACTION_CHUNK at a time, letting the RPCs run in between.
+    # Readers keep using the current arrays until the copies replace them in one step, after
+    # the messages added in the meantime were copied as well.
+    async def compact(self):
+        if self.start == 0 or self.start < len(self):
+            return False
+        start = self.start
+        origin = self.offsets[0]
+        timestamps = array("d")
+        offsets = array("Q", [self.offsets[start]])
+        encoded = bytearray()
+        i = start
+        while True:
+            end = min(i + COMPACTION_CHUNK, len(self.timestamps))
+            timestamps += self.timestamps[i:end]
+            offsets += self.offsets[i + 1:end + 1]
+            encoded += self.encoded[self.offsets[i] - origin:self.offsets[end] - origin]
+            i = end
+            if i == len(self.timestamps):
+                break
+            await asyncio.sleep(0)
+        self.timestamps = timestamps
+        self.offsets = offsets
+        self.encoded = encoded
+        self.base += start
+        self.start = 0
+        return True
+
+
+# A client of Subscribe. AddMessage queues the new messages of its rooms and its stream
+# sends them. The queue is bounded: when it is full the client is too slow, it is removed
+# from its rooms and its stream ends with RESOURCE_EXHAUSTED once the queued messages are
+# sent, so the client can subscribe again from the last ids it received.
+class Subscriber:
+    __slots__ = ("queue", "rooms", "remote", "overflowed")
+
+    def __init__(self, rooms):
+        self.queue = asyncio.Queue(SUBSCRIBER_QUEUE_SIZE)
+        self.rooms = rooms
+        # Tasks forwarding the messages of the rooms owned by other shards, by room name
+        self.remote = {}
+        self.overflowed = False
+
+    # Queue a message, None ends the stream
+    def push(self, reply):
+        try:
+            self.queue.put_nowait(reply)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.unsubscribe()
+
+    def unsubscribe(self):
+        for room in self.rooms:
+            room.subscribers.discard(self)
+        for task in self.remote.values():
+            task.cancel()
+
+    # Stop following a removed room, the stream ends with the last room
+    def remove_room(self, room):
+        self.rooms.remove(room)
+        if not self.rooms and not self.remote:
+            self.push(None)
+
+
+# Limits on the history of a room, 0 uses the server-wide limit
+class Retention:
+    __slots__ = ("max_count", "max_age", "max_bytes")
+
+    def __init__(self, max_count=0, max_age=0, max_bytes=0):
+        self.max_count = max_count
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+
+
+# The limits sent with a room, None if it has none
+def retention_of(request):
+    if not request.HasField("retention"):
+        return None
+    limits = request.retention
+    return Retention(limits.max_count, limits.max_age, limits.max_bytes)
+
+
 # The class to represent a room
 class Room:
-    def __init__(self, room_name):
+    __slots__ = ("room_name", "users", "messages", "subscribers", "retention")
+
+    def __init__(self, room_name, retention=None):
         self.room_name = room_name
         # Current users joined the room
-        self.users = []
+        self.users = set()
         # Current messages in the room
-        self.messages = []
+        self.messages = MessageColumns()
+        # Clients following the new messages of the room
+        self.subscribers = set()
+        # Limits of this room, None for the server-wide ones
+        self.retention = retention
 
     # get the name of the room
     def get_name(self):
@@ -26,7 +498,7 @@ class Room:
     # Join a new user to the room
     def add_user(self, user):
         if not self.has_user(user):
-            self.users.append(user)
+            self.users.add(user)
             return True
         return False
 
@@ -44,27 +516,55 @@ class Room:
     # Add a new message to this room
     def add_message(self, user, msg):
         if self.has_user(user):
-            self.messages.append(Message(user, msg))
+            timestamp = time.time()
+            self.messages.append(user.user_name, msg, timestamp)
+            if self.subscribers:
+                # Built once and shared by all the subscribers
+                reply = chat_pb2.RoomMessage(room=self.room_name, id=self.messages.last(),
+                                             user=user.user_name, msg=msg, timestamp=timestamp)
+                for subscriber in list(self.subscribers):
+                    subscriber.push(reply)
             return True
         return False
 
+    # End the subscriptions to this room when it is removed
+    def close(self):
+        for subscriber in list(self.subscribers):
+            subscriber.remove_room(self)
+        self.subscribers.clear()
+
 
     # Get all the messages of this room
     def get_messages(self):
         return self.messages
 
+    # Remove the messages past the retention limits and return how many were removed
+    def apply_retention(self, now):
+        retention = self.retention or Retention()
+        max_count = retention.max_count or RETENTION_COUNT
+        max_age = retention.max_age or RETENTION_AGE
+        max_bytes = retention.max_bytes or RETENTION_BYTES
+        if not (max_count or max_age or max_bytes):
+            return 0
+        count = self.messages.excess(max_count, now - max_age if max_age else 0, max_bytes)
+        if count:
+            self.messages.trim(count)
+        return count
+
 # Class representing a user
 class User:
+    __slots__ = ("user_name", "rooms")
+
     def __init__(self, user_name):
         # The name of the user
         self.user_name = user_name
         # The rooms this user has joined
-        self.rooms = []
+        self.rooms = set()
 
     # Join a room
     def join_room(self, room):
         if room not in self.rooms:
-            self.rooms.append(room)
+            self.rooms.add(room)
             return True
         return False
 
@@ -83,16 +583,62 @@ class User:
         return room in self.rooms
 
 
+# A message read from the room storage. Only the sender's name is kept,
+# the sender may have been removed since.
 class Message:
-    def __init__(self, user, msg):
-        self.user = user
+    __slots__ = ("user_name", "msg", "timestamp")
+
+    def __init__(self, user_name, msg, timestamp):
+        self.user_name = user_name
         self.msg = msg
+        self.timestamp = timestamp
 
     def get_message(self):
         return self.msg
 
-    def get_user(self):
-        return self.user
+    def get_user_name(self):
+        return self.user_name
+
+    def get_timestamp(self):
+        return self.timestamp
+
+
+# The rooms by name, with their names kept sorted so that the rooms starting with a
+# prefix can be listed a page at a time without going through the others
+class RoomDirectory:
+    def __init__(self):
+        self.rooms = {}
+        self.names = []
+
+    def __len__(self):
+        return len(self.rooms)
+
+    def __iter__(self):
+        return iter(self.rooms.values())
+
+    def get(self, room_name):
+        return self.rooms.get(room_name)
+
+    def add(self, room):
+        self.rooms[room.room_name] = room
+        bisect.insort(self.names, room.room_name)
+
+    def remove(self, room):
+        del self.rooms[room.room_name]
+        del self.names[bisect.bisect_left(self.names, room.room_name)]
+
+    # Up to limit rooms whose name starts with prefix, after the room named after, and
+    # whether there are more
+    def page(self, prefix, after, limit):
+        i = bisect.bisect_left(self.names, prefix)
+        if after:
+            i = max(i, bisect.bisect_right(self.names, after))
+        rooms = []
+        for name in itertools.islice(self.names, i, i + limit + 1):
+            if not name.startswith(prefix):
+                break
+            rooms.append(self.rooms[name])
+        return rooms[:limit], len(rooms) > limit
 
 
 # Class for handling the chat using gRPC
@@ -100,139 +646,690 @@ class Chat(chat_pb2_grpc.ChatServicer):
 
     def __init__(self):
         # All the rooms
-        self.rooms = []
-        # All the users
-        self.users = []
+        self.rooms = RoomDirectory()
+        # All the users, by name
+        self.users = {}
 
     # Search if a room exists and return it
     def search_room(self, room_name):
-        for r in self.rooms:
-            if r.room_name == room_name:
-                return r
-        return None
+        return self.rooms.get(room_name)
     # search if a user exists and return it
     def search_user(self, user_name):
-        for u in self.users:
-            if u.user_name == user_name:
-                return u
-        return None
+        return self.users.get(user_name)
+
+    # The changes below are shared by the single and the batch RPCs
+
+    def create_room(self, room_name, retention=None):
+        if self.search_room(room_name) == None:
+            self.rooms.add(Room(room_name, retention))
+            logger.info("room created", extra={"room": room_name})
+            return True
+        logger.warning("cannot create room", extra={"room": room_name})
+        return False
+
+    def join_room(self, user_name, room_name):
+        user = self.search_user(user_name)
+        room = self.search_room(room_name)
+        if user == None or room == None:
+            logger.warning("user cannot join room", extra={"user": user_name, "room": room_name,
+                                                           "reason": "user or room does not exist"})
+            return False
+        if not (user.join_room(room) and room.add_user(user)):
+            logger.warning("user cannot join room", extra={"user": user_name, "room": room_name,
+                                                           "reason": "already a member"})
+            return False
+        logger.info("user joined room", extra={"user": user_name, "room": room_name})
+        return True
+
+    def leave_room(self, user_name, room_name):
+        user = self.search_user(user_name)
+        room = self.search_room(room_name)
+        if user == None or room == None:
+            logger.warning("user cannot leave room", extra={"user": user_name, "room": room_name,
+                                                            "reason": "user or room does not exist"})
+            return False
+        if not (user.leave_room(room) and room.remove_user(user)):
+            logger.warning("user cannot leave room", extra={"user": user_name, "room": room_name,
+                                                            "reason": "not a member"})
+            return False
+        logger.info("user left room", extra={"user": user_name, "room": room_name})
+        return True
+
+    def add_message(self, user_name, room_name, msg):
+        user = self.search_user(user_name)
+        room = self.search_room(room_name)
+        if user == None or room == None:
+            logger.warning("user cannot send message", extra={"user": user_name, "room": room_name,
+                                                              "reason": "user or room does not exist"})
+            return False
+        if not room.add_message(user, msg):
+            logger.warning("user cannot send message", extra={"user": user_name, "room": room_name,
+                                                              "reason": "not a member"})
+            return False
+        logger.info("message sent", extra={"user": user_name, "room": room_name})
+        return True
+
+    def can_send(self, user_name, room_name):
+        user = self.search_user(user_name)
+        room = self.search_room(room_name)
+        if user == None or room == None:
+            return False
+        return user.can_send(room)
 
     # Create a new room
     async def CreateRoom(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext,) -> chat_pb2.Success:
-        if self.search_room(request.name) == None:
-            self.rooms.append(Room(request.name))
-            print("> Room " + request.name + " created.")
-            return chat_pb2.Success(flag=True)
-        print("* Error: Cannot create room " + request.name + ".")
-        return chat_pb2.Success(flag=False)
+        return chat_pb2.Success(flag=self.create_room(request.name, retention_of(request)))
+
+    # Create several rooms
+    async def CreateRooms(self, request: chat_pb2.Rooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=self.create_room(name))
+                                           for name in request.names])
 
     # Remove a room
     async def RemoveRoom(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext,) -> chat_pb2.Success:
         to_remove = self.search_room(request.name)
         if to_remove != None:
             self.rooms.remove(to_remove)
-            print("> Room " + request.name + " removed.")
+            to_remove.close()
+            logger.info("room removed", extra={"room": request.name})
             return chat_pb2.Success(flag=True)
-        print("* Cannot reamove room " + request.name + ".")
+        logger.warning("cannot remove room", extra={"room": request.name})
         return chat_pb2.Success(flag=False)
 
+    # Change the retention limits of a room, they apply from the next compaction
+    async def SetRetention(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        room = self.search_room(request.name)
+        if room == None:
+            return chat_pb2.Success(flag=False)
+        room.retention = retention_of(request)
+        logger.info("room retention set", extra={"room": request.name})
+        return chat_pb2.Success(flag=True)
+
+    # Background task applying the retention limits. The rooms are handled a few at a time,
+    # it sleeps as soon as it has run for COMPACTION_SLICE so the RPCs are not held up.
+    # The size of the histories is exported as gauges after each pass.
+    async def compact(self):
+        trimmed = 0
+        compactions = 0
+        while True:
+            await asyncio.sleep(COMPACTION_INTERVAL)
+            now = time.time()
+            deadline = time.perf_counter() + COMPACTION_SLICE
+            kept = 0
+            size = 0
+            held = 0
+            for room in list(self.rooms):
+                trimmed += room.apply_retention(now)
+                if await room.messages.compact():
+                    compactions += 1
+                kept += len(room.messages)
+                size += room.messages.size()
+                held += room.messages.nbytes()
+                if time.perf_counter() > deadline:
+                    await asyncio.sleep(0)
+                    deadline = time.perf_counter() + COMPACTION_SLICE
+            metrics.set("messages", kept)
+            metrics.set("message_bytes", size)
+            metrics.set("history_memory_bytes", held)
+            metrics.set("messages_trimmed_total", trimmed, "counter")
+            metrics.set("compactions_total", compactions, "counter")
+
 
     # Get all the rooms
     async def GetRooms(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Reply:
-        rooms_list = ''
         user = self.search_user(request.name)
-        for room in self.rooms:
-            rooms_list += '\t' + room.get_name()
-            if(room.has_user(user)):
-                rooms_list += ' [joined]'
-            rooms_list += '\n'
-        print("> Listing the rooms for client " + request.name)
+        joined = user.rooms if user != None else ()
+        rooms_list = "".join(f"\t{room.room_name}{' [joined]' if room in joined else ''}\n" for room in self.rooms)
+        logger.debug("rooms listed", extra={"user": request.name})
         return chat_pb2.Reply(text=rooms_list)
 
+    # A page of the rooms, in name order
+    async def ListRooms(self, request: chat_pb2.RoomQuery, context: grpc.aio.ServicerContext) -> chat_pb2.RoomPage:
+        user = self.search_user(request.user)
+        joined = user.rooms if user != None else ()
+        limit = min(request.limit or ROOM_PAGE_SIZE, MAX_PAGE_SIZE)
+        rooms, more = self.rooms.page(request.prefix, request.page_token, limit)
+        reply = chat_pb2.RoomPage(rooms=[chat_pb2.RoomEntry(name=room.room_name, joined=room in joined)
+                                         for room in rooms])
+        if more:
+            reply.next_page_token = rooms[-1].room_name
+        logger.debug("rooms listed", extra={"user": request.user, "prefix": request.prefix})
+        return reply
+
     # Add a new user
     async def AddUser(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
         if self.search_user(request.name) == None:
-            self.users.append(User(request.name))
-            print("> User " + request.name + " was added.")
+            self.users[request.name] = User(request.name)
+            logger.info("user added", extra={"user": request.name})
             return chat_pb2.Success(flag=True)
-        print("* Cannot add user " + request.name + ".")
+        logger.warning("cannot add user", extra={"user": request.name})
         return chat_pb2.Success(flag=False)
 
     # Remove a user
     async def RemoveUser(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
         to_remove = self.search_user(request.name)
         if to_remove != None:
-            self.users.remove(to_remove)
-            for r in self.rooms:
+            del self.users[request.name]
+            for r in to_remove.rooms:
                 r.remove_user(to_remove)
-            print("> User " + request.name + " was removed.")
+            logger.info("user removed", extra={"user": request.name})
             return chat_pb2.Success(flag=True)
-        print("* Cannot remove user " + request.name + ".")
+        logger.warning("cannot remove user", extra={"user": request.name})
         return chat_pb2.Success(flag=False)
 
     # Join a room
     async def JoinRoom(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
-        user = self.search_user(request.user)
-        room = self.search_room(request.room)
-        if user == None or room == None:
-            print("* User " + request.user + " cannot join room " + request.room + ".")
-            return chat_pb2.Success(flag=False)
-        result = user.join_room(room) and room.add_user(user)
-        print("> User " + request.user + " joined room " + request.room + ".")
-        return chat_pb2.Success(flag=result)
+        return chat_pb2.Success(flag=self.join_room(request.user, request.room))
+
+    # Join several rooms
+    async def JoinRooms(self, request: chat_pb2.UserRooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=self.join_room(request.user, name))
+                                           for name in request.rooms])
 
     # Leave a room
     async def LeaveRoom(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
-        user = self.search_user(request.user)
-        room = self.search_room(request.room)
-        if user == None or room == None:
-            print("* User " + request.user + " cannot leave room " + request.room + ".")
-            return chat_pb2.Success(flag=False)
-        print("> User " + request.user + " left room " + request.room + ".")
-        return chat_pb2.Success(flag= (user.leave_room(room) and room.remove_user(user)))
+        return chat_pb2.Success(flag=self.leave_room(request.user, request.room))
+
+    # Leave several rooms
+    async def LeaveRooms(self, request: chat_pb2.UserRooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=self.leave_room(request.user, name))
+                                           for name in request.rooms])
 
     # Add a new message
     async def AddMessage(self, request: chat_pb2.UserRoomMessage, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
-        user = self.search_user(request.user)
-        room = self.search_room(request.room)
-        if user == None or room == None:
-            print("* User " + request.user + " cannot send message in room " + request.room + ".")
-            return chat_pb2.Success(flag=False)
-        print("> User " + request.user + " sent message in room " + request.room + ".")
-        return chat_pb2.Success(flag= (room.add_message(user, request.msg)))
+        return chat_pb2.Success(flag=self.add_message(request.user, request.room, request.msg))
+
+    # Send a message to several rooms. With all_or_none the message is only sent if the
+    # user can send to every room, otherwise the rooms it cannot send to are skipped.
+    async def BroadcastMessage(self, request: chat_pb2.UserRoomsMessage, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        allowed = [self.can_send(request.user, name) for name in request.rooms]
+        if request.all_or_none and not all(allowed):
+            logger.warning("user cannot send message", extra={"user": request.user, "rooms": list(request.rooms)})
+            return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=False) for name in request.rooms])
+        return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=ok and self.add_message(request.user, name, request.msg))
+                                           for name, ok in zip(request.rooms, allowed)])
 
-    # Get all the messages for a room
-    async def GetMessages(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext) -> chat_pb2.Messages:
-        print("> displaying messages in room " + request.name + ".")
+    # Get a page of the messages of a room
+    async def GetMessages(self, request: chat_pb2.MessageQuery, context: grpc.aio.ServicerContext) -> chat_pb2.Messages:
+        logger.debug("messages read", extra={"room": request.name})
         room = self.search_room(request.name)
         if room == None:
-            return chat_pb2.Messages(text=None)
-        msg_objects = room.get_messages()
-        msg_list = []
-        for mo in msg_objects:
-            msg_list.append(mo.get_user().user_name + ':\n' + mo.get_message())
-
-        return chat_pb2.Messages(text=msg_list)
+            return chat_pb2.Messages(found=False)
+        since_id = request.since_id
+        if request.page_token:
+            if not request.page_token.isdigit():
+                await context.abort(grpc.StatusCode.INVALID_ARGUMENT, "Invalid page token")
+            since_id = int(request.page_token)
+        limit = min(request.limit or PAGE_SIZE, MAX_PAGE_SIZE)
+        # Message ids are the index in the history plus one
+        total = room.messages.last()
+        trimmed = room.messages.first()
+        start = min(max(since_id, trimmed), total)
+        end = min(start + limit, total)
+        reply = room.messages.page(start, end)
+        reply.found = True
+        reply.last_id = total
+        reply.trimmed_id = trimmed
+        if end < total:
+            reply.next_page_token = str(end)
+        return reply
 
     # Check if user can send message to a room
     async def CanSend(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
-        user = self.search_user(request.user)
-        room = self.search_room(request.room)
-        if user == None or room == None:
+        return chat_pb2.Success(flag=self.can_send(request.user, request.room))
+
+    # Add the subscriber to the existing rooms of a subscription and return them with the
+    # number of messages they had. There is no await in between, so every message is
+    # either in the history before that number or queued for the subscriber.
+    def subscribe(self, subscriber, request):
+        rooms = {}
+        last_ids = {}
+        for name in request.rooms:
+            room = self.search_room(name)
+            if room != None:
+                rooms[name] = room
+                last_ids[name] = room.messages.last()
+                subscriber.rooms.add(room)
+                room.subscribers.add(subscriber)
+        if rooms:
+            logger.info("client subscribed", extra={"rooms": list(rooms)})
+        return rooms, last_ids
+
+    # The messages a subscription asked for with after, up to the ones already queued.
+    # The ones removed by the retention limits in the meantime are skipped.
+    def history(self, request, rooms, last_ids):
+        for name, after in request.after.items():
+            room = rooms.get(name)
+            if room == None:
+                continue
+            i = after
+            while True:
+                i = max(i, room.messages.first())
+                if i >= last_ids[name]:
+                    break
+                mo = room.messages.get(i)
+                i += 1
+                yield chat_pb2.RoomMessage(room=name, id=i, user=mo.get_user_name(),
+                                           msg=mo.get_message(), timestamp=mo.get_timestamp())
+
+    # Stream the new messages of one or more rooms
+    async def Subscribe(self, request: chat_pb2.Subscription, context: grpc.aio.ServicerContext):
+        subscriber = Subscriber(set())
+        rooms, last_ids = self.subscribe(subscriber, request)
+        if not rooms:
+            await context.abort(grpc.StatusCode.NOT_FOUND, "None of the rooms exist")
+        try:
+            for reply in self.history(request, rooms, last_ids):
+                yield reply
+            while True:
+                if subscriber.overflowed and subscriber.queue.empty():
+                    logger.warning("slow subscriber dropped", extra={"rooms": list(rooms)})
+                    await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                        "Too many messages were not received, subscribe again")
+                reply = await subscriber.queue.get()
+                if reply == None:
+                    # Checked again at the top once the queue is empty
+                    if subscriber.overflowed:
+                        continue
+                    return
+                yield reply
+        finally:
+            subscriber.unsubscribe()
+
+    # Run the commands of a session in order and queue their results with the messages
+    # pushed to the session. Commands wait while the queue is full, they are never dropped.
+    async def run_session(self, request_iterator, context, subscriber):
+        try:
+            async for command in request_iterator:
+                kind = command.WhichOneof("command")
+                request = getattr(command, kind) if kind != None else None
+                result = chat_pb2.Result(id=command.id)
+                if kind == None:
+                    result.flag = False
+                elif kind == "subscribe":
+                    rooms, last_ids = self.subscribe(subscriber, request)
+                    result.flag = bool(rooms)
+                    await subscriber.queue.put(SessionHistory(self.history(request, rooms, last_ids)))
+                elif kind == "unsubscribe":
+                    for name in request.rooms:
+                        room = self.search_room(name)
+                        if room in subscriber.rooms:
+                            subscriber.rooms.remove(room)
+                            room.subscribers.discard(subscriber)
+                        task = subscriber.remote.pop(name, None)
+                        if task != None:
+                            task.cancel()
+                    result.flag = True
+                else:
+                    reply = await getattr(self, session_commands[kind])(request, context)
+                    if isinstance(reply, chat_pb2.Reply):
+                        result.flag = True
+                        result.text = reply.text
+                    else:
+                        result.flag = reply.flag
+                await subscriber.queue.put(chat_pb2.Event(result=result))
+        finally:
+            await subscriber.queue.put(SESSION_END)
+
+    # Pipeline commands tagged with ids over one stream. The results come back with the
+    # ids of their commands, mixed with the messages of the rooms the session subscribed to.
+    # The session shares the queue bound and slow-consumer policy of Subscribe.
+    async def Session(self, request_iterator, context: grpc.aio.ServicerContext):
+        subscriber = Subscriber(set())
+        reader = asyncio.ensure_future(self.run_session(request_iterator, context, subscriber))
+        try:
+            while True:
+                if subscriber.overflowed and subscriber.queue.empty():
+                    logger.warning("slow session dropped", extra={"rooms": len(subscriber.rooms)})
+                    await context.abort(grpc.StatusCode.RESOURCE_EXHAUSTED,
+                                        "Too many messages were not received, start a new session")
+                event = await subscriber.queue.get()
+                if event is SESSION_END:
+                    break
+                if isinstance(event, SessionHistory):
+                    for reply in event.replies:
+                        yield chat_pb2.Event(message=reply)
+                    continue
+                # None only means that the rooms followed so far were all removed
+                if event == None:
+                    continue
+                if isinstance(event, chat_pb2.RoomMessage):
+                    event = chat_pb2.Event(message=event)
+                yield event
+            # A command that failed ends the session with its error
+            await reader
+        finally:
+            reader.cancel()
+            subscriber.unsubscribe()
+
+
+# Shard owning a room or a user
+def shard_of(name, shards):
+    return zlib.crc32(name.encode()) % shards
+
+# Metadata of the calls between shards that only ask for the part of the shard
+LOCAL_CALL = (("x-chat-local", "1"),)
+
+
+# The servicer of one worker when the state is split between several processes.
+# Each shard owns the rooms and the users whose name hashes to it. A room's shard
+# keeps its members and messages, with a local User for each member. A user's shard
+# only keeps whether it exists and its generation (the time it was added).
+# Removing a user sends DropUser to every shard, which removes the user from its rooms
+# and remembers the generation, so a join of that user still in flight is refused.
+class ShardedChat(Chat):
+
+    def __init__(self, shard, shards):
+        super().__init__()
+        self.shard = shard
+        self.shards = shards
+        # Stubs of all the shards, this one included
+        self.peers = [chat_pb2_grpc.ChatStub(grpc.aio.insecure_channel(f"127.0.0.1:{SHARD_PORT + i}"))
+                      for i in range(shards)]
+        # Generation of the users owned by this shard
+        self.generations = {}
+        # Generation of the removed users, joins of older generations are refused
+        self.dropped = {}
+
+    def owner(self, name):
+        return shard_of(name, self.shards)
+
+    # Forward a call to the shard owning name, None when this shard owns it
+    async def forward(self, rpc, request, name):
+        owner = self.owner(name)
+        if owner == self.shard:
+            return None
+        return await getattr(self.peers[owner], rpc)(request, metadata=trace_metadata())
+
+    # Run a batch call on the shards owning its rooms and put the statuses back in the
+    # order of the request, None when this shard owns all the rooms
+    async def forward_batch(self, rpc, request, field):
+        names = list(getattr(request, field))
+        groups = {}
+        for i, name in enumerate(names):
+            groups.setdefault(self.owner(name), []).append(i)
+        if list(groups) == [self.shard]:
+            return None
+        calls = []
+        for owner, positions in groups.items():
+            part = type(request)()
+            part.CopyFrom(request)
+            del getattr(part, field)[:]
+            getattr(part, field).extend(names[i] for i in positions)
+            calls.append(getattr(self.peers[owner], rpc)(part, metadata=trace_metadata()))
+        statuses = [None] * len(names)
+        for positions, reply in zip(groups.values(), await asyncio.gather(*calls)):
+            for i, status in zip(positions, reply.statuses):
+                statuses[i] = status
+        return chat_pb2.Statuses(statuses=statuses)
+
+    async def lookup_user(self, user_name):
+        reply = await self.forward("LookupUser", chat_pb2.User(name=user_name), user_name)
+        if reply != None:
+            return reply
+        generation = self.generations.get(user_name)
+        return chat_pb2.UserInfo(name=user_name, found=generation != None, generation=generation or 0)
+
+    # Join local rooms once the user's shard confirmed the user exists
+    async def join_local(self, user_name, room_names):
+        info = await self.lookup_user(user_name)
+        if not info.found or self.dropped.get(user_name, 0) >= info.generation:
+            logger.warning("user cannot join room", extra={"user": user_name, "rooms": list(room_names)})
+            return [False] * len(room_names)
+        if self.search_user(user_name) == None:
+            self.users[user_name] = User(user_name)
+        return [self.join_room(user_name, name) for name in room_names]
+
+    # Whether a user exists and its generation, asked by the other shards
+    async def LookupUser(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.UserInfo:
+        return await self.lookup_user(request.name)
+
+    # Remove a removed user from the rooms of this shard
+    async def DropUser(self, request: chat_pb2.UserInfo, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        self.dropped[request.name] = max(self.dropped.get(request.name, 0), request.generation)
+        user = self.search_user(request.name)
+        if user != None:
+            del self.users[request.name]
+            for r in list(user.rooms):
+                r.remove_user(user)
+        return chat_pb2.Success(flag=True)
+
+    async def AddUser(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("AddUser", request, request.name)
+        if reply != None:
+            return reply
+        if request.name in self.generations:
+            logger.warning("cannot add user", extra={"user": request.name})
             return chat_pb2.Success(flag=False)
-        return chat_pb2.Success(flag=user.can_send(room))
+        self.generations[request.name] = time.time_ns()
+        logger.info("user added", extra={"user": request.name})
+        return chat_pb2.Success(flag=True)
 
-# Start the gRPC server
-async def serve() -> None:
-    server = grpc.aio.server()
-    chat_pb2_grpc.add_ChatServicer_to_server(Chat(), server)
+    async def RemoveUser(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("RemoveUser", request, request.name)
+        if reply != None:
+            return reply
+        generation = self.generations.pop(request.name, None)
+        if generation == None:
+            logger.warning("cannot remove user", extra={"user": request.name})
+            return chat_pb2.Success(flag=False)
+        info = chat_pb2.UserInfo(name=request.name, found=True, generation=generation)
+        await asyncio.gather(*(peer.DropUser(info, metadata=trace_metadata()) for peer in self.peers))
+        logger.info("user removed", extra={"user": request.name})
+        return chat_pb2.Success(flag=True)
+
+    # The rooms of every shard, or only of this one when asked by another shard
+    async def GetRooms(self, request: chat_pb2.User, context: grpc.aio.ServicerContext) -> chat_pb2.Reply:
+        if dict(context.invocation_metadata()).get("x-chat-local"):
+            return await super().GetRooms(request, context)
+        replies = await asyncio.gather(*(peer.GetRooms(request, metadata=LOCAL_CALL + trace_metadata())
+                                         for peer in self.peers))
+        return chat_pb2.Reply(text="".join(reply.text for reply in replies))
+
+    # Every shard lists a page of its own rooms and the pages are merged
+    async def ListRooms(self, request: chat_pb2.RoomQuery, context: grpc.aio.ServicerContext) -> chat_pb2.RoomPage:
+        if dict(context.invocation_metadata()).get("x-chat-local"):
+            return await super().ListRooms(request, context)
+        replies = await asyncio.gather(*(peer.ListRooms(request, metadata=LOCAL_CALL + trace_metadata())
+                                         for peer in self.peers))
+        limit = min(request.limit or ROOM_PAGE_SIZE, MAX_PAGE_SIZE)
+        rooms = sorted((room for reply in replies for room in reply.rooms), key=lambda room: room.name)
+        reply = chat_pb2.RoomPage(rooms=rooms[:limit])
+        if len(rooms) > limit or any(page.next_page_token for page in replies):
+            reply.next_page_token = rooms[limit - 1].name if len(rooms) > limit else rooms[-1].name
+        return reply
+
+    async def CreateRoom(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("CreateRoom", request, request.name)
+        return reply if reply != None else await super().CreateRoom(request, context)
+
+    async def RemoveRoom(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("RemoveRoom", request, request.name)
+        return reply if reply != None else await super().RemoveRoom(request, context)
+
+    async def SetRetention(self, request: chat_pb2.Room, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("SetRetention", request, request.name)
+        return reply if reply != None else await super().SetRetention(request, context)
+
+    async def JoinRoom(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("JoinRoom", request, request.room)
+        if reply != None:
+            return reply
+        return chat_pb2.Success(flag=(await self.join_local(request.user, [request.room]))[0])
+
+    async def LeaveRoom(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("LeaveRoom", request, request.room)
+        return reply if reply != None else await super().LeaveRoom(request, context)
+
+    async def AddMessage(self, request: chat_pb2.UserRoomMessage, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("AddMessage", request, request.room)
+        return reply if reply != None else await super().AddMessage(request, context)
+
+    async def CanSend(self, request: chat_pb2.UserRoom, context: grpc.aio.ServicerContext) -> chat_pb2.Success:
+        reply = await self.forward("CanSend", request, request.room)
+        return reply if reply != None else await super().CanSend(request, context)
+
+    async def GetMessages(self, request: chat_pb2.MessageQuery, context: grpc.aio.ServicerContext) -> chat_pb2.Messages:
+        reply = await self.forward("GetMessages", request, request.name)
+        return reply if reply != None else await super().GetMessages(request, context)
+
+    async def CreateRooms(self, request: chat_pb2.Rooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        reply = await self.forward_batch("CreateRooms", request, "names")
+        return reply if reply != None else await super().CreateRooms(request, context)
+
+    async def JoinRooms(self, request: chat_pb2.UserRooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        reply = await self.forward_batch("JoinRooms", request, "rooms")
+        if reply != None:
+            return reply
+        flags = await self.join_local(request.user, request.rooms)
+        return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=flag)
+                                           for name, flag in zip(request.rooms, flags)])
+
+    async def LeaveRooms(self, request: chat_pb2.UserRooms, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        reply = await self.forward_batch("LeaveRooms", request, "rooms")
+        return reply if reply != None else await super().LeaveRooms(request, context)
+
+    # With all_or_none the rooms are checked on their shards before anything is sent
+    async def BroadcastMessage(self, request: chat_pb2.UserRoomsMessage, context: grpc.aio.ServicerContext) -> chat_pb2.Statuses:
+        if all(self.owner(name) == self.shard for name in request.rooms):
+            return await super().BroadcastMessage(request, context)
+        if request.all_or_none:
+            checks = [self.CanSend(chat_pb2.UserRoom(user=request.user, room=name), context) for name in request.rooms]
+            if not all(reply.flag for reply in await asyncio.gather(*checks)):
+                logger.warning("user cannot send message", extra={"user": request.user, "rooms": list(request.rooms)})
+                return chat_pb2.Statuses(statuses=[chat_pb2.RoomStatus(room=name, flag=False) for name in request.rooms])
+            request = chat_pb2.UserRoomsMessage(user=request.user, rooms=request.rooms, msg=request.msg)
+        return await self.forward_batch("BroadcastMessage", request, "rooms")
+
+    # Follow the local rooms directly and the other ones through a stream from their shard
+    def subscribe(self, subscriber, request):
+        local = chat_pb2.Subscription(rooms=[name for name in request.rooms if self.owner(name) == self.shard])
+        rooms, last_ids = super().subscribe(subscriber, local)
+        for name in request.rooms:
+            owner = self.owner(name)
+            if owner != self.shard and name not in subscriber.remote:
+                after = request.after[name] if name in request.after else None
+                subscriber.remote[name] = asyncio.ensure_future(self.forward_room(subscriber, owner, name, after))
+                rooms[name] = None
+        return rooms, last_ids
+
+    # Queue the messages of a room owned by another shard. They wait for room in the queue,
+    # so a slow client gets dropped by the owner of the room and then by this shard.
+    async def forward_room(self, subscriber, owner, name, after):
+        request = chat_pb2.Subscription(rooms=[name], after={name: after} if after != None else {})
+        try:
+            async for reply in self.peers[owner].Subscribe(request, metadata=trace_metadata()):
+                await subscriber.queue.put(reply)
+        except grpc.RpcError as e:
+            if e.code() == grpc.StatusCode.RESOURCE_EXHAUSTED:
+                subscriber.overflowed = True
+                subscriber.unsubscribe()
+        if subscriber.overflowed:
+            # Wake the stream up so it ends
+            subscriber.push(None)
+        elif subscriber.remote.get(name) is asyncio.current_task():
+            # The room was removed (or does not exist)
+            del subscriber.remote[name]
+            if not subscriber.rooms and not subscriber.remote:
+                subscriber.push(None)
+
+
+# The RPC running each command of a session
+session_commands = {
+    "create_room": "CreateRoom",
+    "remove_room": "RemoveRoom",
+    "get_rooms": "GetRooms",
+    "add_user": "AddUser",
+    "remove_user": "RemoveUser",
+    "join_room": "JoinRoom",
+    "leave_room": "LeaveRoom",
+    "add_message": "AddMessage",
+    "can_send": "CanSend",
+}
+
+# Queued when the client closes its side of a session
+SESSION_END = object()
+
+# Queued by the subscribe command of a session for the messages it asked for with after.
+# Session sends them one by one as they are read, like Subscribe, so a long history is
+# never built into a single message.
+class SessionHistory:
+    __slots__ = ("replies",)
+
+    def __init__(self, replies):
+        self.replies = replies
+
+# Start the gRPC server, or the worker of one shard when there are several.
+# The workers share the public port through SO_REUSEPORT (on by default in gRPC on Linux).
+async def serve(shard=0, shards=1, parent=None) -> None:
+    chat = Chat() if shards == 1 else ShardedChat(shard, shards)
+    server = grpc.aio.server(interceptors=[MetricsInterceptor()])
+    chat_pb2_grpc.add_ChatServicer_to_server(chat, server)
     listen_addr = "[::]:8080"
     server.add_insecure_port(listen_addr)
-    logging.info("Starting server on %s", listen_addr)
+    logger.info("starting server", extra={"address": listen_addr, "shard": shard, "shards": shards})
     await server.start()
+    compaction = asyncio.create_task(chat.compact())
+    if shards > 1:
+        # Without SO_REUSEPORT so a worker left over from a previous run makes this fail
+        # instead of getting part of the calls meant for this shard
+        internal = grpc.aio.server(interceptors=[MetricsInterceptor()], options=[("grpc.so_reuseport", 0)])
+        chat_pb2_grpc.add_ChatServicer_to_server(chat, internal)
+        internal.add_insecure_port(f"127.0.0.1:{SHARD_PORT + shard}")
+        await internal.start()
+    if METRICS_PORT:
+        await asyncio.start_server(handle_metrics, port=METRICS_PORT + shard)
+        logger.info("serving metrics", extra={"port": METRICS_PORT + shard})
+    stopper = asyncio.create_task(stop_on_exit(server, parent))
     await server.wait_for_termination()
+    compaction.cancel()
+    stopper.cancel()
+    if shards > 1:
+        await internal.stop(None)
+
+# Stop the server on SIGTERM (docker stop, or serve_workers stopping its workers) or SIGINT. A worker
+# also stops once the process that started it is gone, even killed without a chance to stop
+# its workers, so they do not keep holding the public port.
+async def stop_on_exit(server, parent):
+    stop = asyncio.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        asyncio.get_running_loop().add_signal_handler(signum, stop.set)
+    while not stop.is_set():
+        try:
+            await asyncio.wait_for(stop.wait(), PARENT_CHECK_INTERVAL if parent != None else None)
+        except asyncio.TimeoutError:
+            if os.getppid() != parent:
+                logger.warning("parent process gone, stopping", extra={"parent": parent})
+                break
+    await server.stop(None)
+
+def run_worker(shard, shards, parent):
+    setup_logging()
+    asyncio.run(serve(shard, shards, parent))
+
+# Run one process per shard and wait for them. The workers are stopped when this process
+# is, by SIGTERM or SIGINT.
+def serve_workers(shards):
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda signum, frame: sys.exit(0))
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=run_worker, args=(i, shards, os.getpid()), name=f"shard-{i}")
+               for i in range(shards)]
+    for worker in workers:
+        worker.start()
+    try:
+        for worker in workers:
+            worker.join()
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.join()
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=logging.INFO)
-    asyncio.run(serve())
+    if WORKERS > 1:
+        serve_workers(WORKERS)
+    else:
+        setup_logging()
+        asyncio.run(serve())
@@ -1,4 +1,3 @@
-import 'dart:async';
 import 'dart:convert';
 
 import 'package:flutter/material.dart';
@@ -127,21 +126,39 @@ class SecondScreenState extends State<SecondScreen> {
   List<String> chatrooms = [];
   List<String> joinedRooms = [];
   List<String> messages = [];
-  Timer? refreshTimer;
+  // Room the messages were loaded for and the id of the last one received
+  String? messagesRoom;
+  int lastMessageId = 0;
+  bool following = true;
+  // Client of the pending /subscribe request, closed to abort it when the room changes
+  http.Client? subscribeClient;
+  // Changed on every room switch so the aborted request is followed up right away
+  int followGeneration = 0;
 
   @override
   void initState() {
     super.initState();
     fetchChatrooms();
-    startAutoRefresh();
+    followMessages();
   }
 
   @override
   void dispose() {
-    refreshTimer?.cancel();
+    following = false;
+    subscribeClient?.close();
     super.dispose();
   }
 
+  // Show another room: the wait for the messages of the previous one is aborted and
+  // followMessages loads the new one at once
+  void selectChatroom(String? room) {
+    setState(() {
+      selectedChatroom = room;
+    });
+    followGeneration++;
+    subscribeClient?.close();
+  }
+
   Future<void> fetchChatrooms() async {
     try {
       final url = Uri.parse('http://127.0.0.1:5000/get-rooms');
@@ -271,27 +288,45 @@ class SecondScreenState extends State<SecondScreen> {
     }
   }
 
+  // Add the messages past lastMessageId to the list.
+  // Overlapping requests can return the same messages, skip the ones we have.
+  void appendMessages(List<dynamic> received) {
+    setState(() {
+      for (final m in received) {
+        if (m['id'] > lastMessageId) {
+          messages.add("${m['user']}:\n${m['message']}");
+          lastMessageId = m['id'];
+        }
+      }
+    });
+  }
+
   Future<void> fetchMessages() async {
     if (selectedChatroom == null) return;
+    String room = selectedChatroom!;
+    if (room != messagesRoom) {
+      messagesRoom = room;
+      lastMessageId = 0;
+      messages = [];
+    }
 
     try {
       final url = Uri.parse('http://127.0.0.1:5000/get-messages');
+      // Only ask for the messages we haven't seen yet
       final response = await http.post(
         url,
         headers: {'Content-Type': 'application/json'},
-        body: jsonEncode({'room-name': selectedChatroom}),
+        body: jsonEncode({'room-name': room, 'after': lastMessageId}),
       );
+      if (room != messagesRoom) return;
 
       if (response.statusCode == 200) {
         final responseData = jsonDecode(response.body);
-        setState(() {
-          messages = responseData['success'] != null
-              ? List<String>.from(responseData['success'])
-              : ["No messages"];
-        });
+        appendMessages(responseData['messages'] ?? []);
       } else {
         setState(() {
-          messages = ["No messages"];
+          messages = [];
+          lastMessageId = 0;
         });
       }
     } catch (e) {
@@ -335,10 +370,51 @@ class SecondScreenState extends State<SecondScreen> {
     }
   }
 
-  void startAutoRefresh() {
-    refreshTimer = Timer.periodic(Duration(seconds: 1), (timer) {
-      if (selectedChatroom != null) fetchMessages();
-    });
+  // Wait for new messages in the selected room with /subscribe.
+  // The server holds each request until there is something new, so nothing is polled.
+  Future<void> followMessages() async {
+    while (following) {
+      String? room = selectedChatroom;
+      int generation = followGeneration;
+      if (room == null) {
+        await Future.delayed(Duration(seconds: 1));
+        continue;
+      }
+      if (room != messagesRoom) {
+        await fetchMessages();
+      }
+      // The room was switched while its messages were loading
+      if (generation != followGeneration) continue;
+
+      final client = http.Client();
+      subscribeClient = client;
+      try {
+        final url = Uri.parse('http://127.0.0.1:5000/subscribe');
+        final response = await client.post(
+          url,
+          headers: {'Content-Type': 'application/json'},
+          body: jsonEncode({
+            'rooms': {room: lastMessageId},
+            'timeout': 25,
+          }),
+        );
+        if (!following || room != messagesRoom) continue;
+
+        if (response.statusCode == 200) {
+          final responseData = jsonDecode(response.body);
+          appendMessages(responseData['messages'][room] ?? []);
+        } else {
+          await Future.delayed(Duration(seconds: 1));
+        }
+      } catch (e) {
+        // Aborted by a room switch, follow the new room without waiting
+        if (generation != followGeneration) continue;
+        await Future.delayed(Duration(seconds: 1));
+      } finally {
+        client.close();
+        if (subscribeClient == client) subscribeClient = null;
+      }
+    }
   }
 
   void showError(String message) {
@@ -396,11 +472,7 @@ class SecondScreenState extends State<SecondScreen> {
                         child: Text(room),
                       );
                     }).toList(),
-                    onChanged: (value) {
-                      setState(() {
-                        selectedChatroom = value;
-                      });
-                    },
+                    onChanged: selectChatroom,
                   ),
                 ),
                 SizedBox(width: 10),
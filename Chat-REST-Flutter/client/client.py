@@ -17,6 +17,16 @@ def post(route, json_dict):
     return requests.post(f"{SERVER_URL}/{route}", json=json_dict)
 
 
+# Run the same operation for every room in one request, returns the result of each room
+def post_batch(op, rooms, fields):
+    operations = [dict(fields, op=op, **{"room-name": room}) for room in rooms]
+    result = post("batch", {"operations": operations})
+    if result.status_code != 200:
+        error = {"status": result.status_code, "error": result.json().get('error')}
+        return [error for room in rooms]
+    return result.json().get('success')
+
+
 # Gets a command from the user and sends it to the server using gRPC
 def get_command():
     global args
@@ -38,6 +48,8 @@ def get_command():
         print("  display <chatroom1>\n")
         print("*Send a message to one or multiple chatrooms:")
         print("  send <chatroom1> [chatroom2 chatroom3 ...]\n")
+        print("*Show new messages of one or multiple chatrooms as they arrive (Ctrl+C to stop):")
+        print("  follow <chatroom1> [chatroom2 chatroom3 ...]\n")
         print("*Show this help text:")
         print("  help\n")
         print("*Quit:")
@@ -49,7 +61,8 @@ def get_command():
         if (args[0] == "send" or
             args[0] == "join" or
             args[0] == "leave" or
-            args[0] == "create"
+            args[0] == "create" or
+            args[0] == "follow"
         ):
             if len(args) < 2:
                 print("> This command needs at least one argument")
@@ -66,31 +79,31 @@ def get_command():
 
 
         if args[0] == "create":
-            for arg in args[1:]:
-                result = post("create-room", {"room-name": arg})
-                if result.status_code == 200:
+            results = post_batch("create-room", args[1:], {})
+            for arg, result in zip(args[1:], results):
+                if result.get('status') == 200:
                     print("> Chatroom " + arg + " created.")
                 else:
                     print("* Error creating chatroom " + arg + ":")
-                    print(result.json().get('error'))
+                    print(result.get('error'))
 
         elif args[0] == "join":
-            for arg in args[1:]:
-                result = post("join-room", {"user-name": user_name, "room-name": arg})
-                if result.status_code == 200:
+            results = post_batch("join-room", args[1:], {"user-name": user_name})
+            for arg, result in zip(args[1:], results):
+                if result.get('status') == 200:
                     print("> You joined chatroom " + arg + ".")
                 else:
                     print("* Error joining chatroom " + arg + ".")
-                    print(result.json().get('error'))
+                    print(result.get('error'))
 
         elif args[0] == "leave":
-            for arg in args[1:]:
-                result = post("leave-room", {"user-name": user_name, "room-name": arg})
-                if result.status_code == 200:
+            results = post_batch("leave-room", args[1:], {"user-name": user_name})
+            for arg, result in zip(args[1:], results):
+                if result.get('status') == 200:
                     print("> You left chatroom " + arg + ".")
                 else:
                     print("* Error leaving chatroom " + arg + ".")
-                    print(result.json().get('error'))
+                    print(result.get('error'))
 
         elif args[0] == "send":
             add_message()
@@ -117,6 +130,9 @@ def get_command():
                 for m in messages:
                     print(m)
 
+        elif args[0] == "follow":
+            follow()
+
         elif args[0] == "quit":
             return
 
@@ -130,9 +146,8 @@ def add_message():
     global command
     global user_name
     # Check if we can send message to all the rooms given in the command args
-    for arg in args[1:]:
-        result = post("can-send", {"user-name": user_name, "room-name": arg})
-        if result.status_code != 200:
+    for result in post_batch("can-send", args[1:], {"user-name": user_name}):
+        if result.get('status') != 200:
             print("> You can't send message to this room.")
             return
 
@@ -144,15 +159,38 @@ def add_message():
         line = input('>>> ')
 
     # Send to the server
-    for arg in args[1:]:
-        result = post('add-message', {"user-name":user_name, "room-name":arg, "message":text})
-        if result.status_code == 200:
+    results = post_batch("add-message", args[1:], {"user-name": user_name, "message": text})
+    for arg, result in zip(args[1:], results):
+        if result.get('status') == 200:
             print("> Sent to " + arg)
         else:
             print("> Unable to send to " + arg)
-            print(result.json().get('error'))
+            print(result.get('error'))
+
 
 
+# Print the new messages of the rooms given in the command args until Ctrl+C.
+# Each request is held by the server until there is something new, so nothing is polled.
+def follow():
+    global args
+    cursors = {arg: None for arg in args[1:]}
+    print("> Following " + ", ".join(cursors) + " (Ctrl+C to stop).")
+    try:
+        while cursors:
+            result = post("subscribe", {"rooms": cursors})
+            if result.status_code != 200:
+                print("* " + result.json().get('error'))
+                return
+            data = result.json()
+            for room, messages in data.get('success').items():
+                for m in messages:
+                    print("[" + room + "] " + m)
+            for room in data.get('removed') + data.get('missing'):
+                print("> Room " + room + " does not exist.")
+            cursors = data.get('cursors')
+    except KeyboardInterrupt:
+        print()
+
 
 # Sign up a new client with a username
 def sign_up():
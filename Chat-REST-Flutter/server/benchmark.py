@@ -0,0 +1,165 @@
+import os
+import random
+import sys
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+# Measure the request handling, not the disk or the logs
+os.environ.setdefault("CHAT_DATA_DIR", "")
+os.environ.setdefault("CHAT_LOG_LEVEL", "ERROR")
+
+import server
+
+
+# Number of rooms/users created for each benchmark run
+SIZES = [1000, 10000, 50000]
+
+# Number of timed requests per operation
+REPEAT = 2000
+
+
+# Reset the server state between runs
+def reset():
+    for room in server.rooms.values():
+        room.close()
+    server.rooms.clear()
+    server.users.clear()
+
+
+# Fill the server with n rooms and n users, each user joined to one room
+def populate(client, n):
+    for i in range(n):
+        client.post("/create-room", json={"room-name": f"room{i}"})
+        client.post("/add-user", json={"user-name": f"user{i}"})
+        client.post("/join-room", json={"user-name": f"user{i}", "room-name": f"room{i}"})
+
+
+# Time REPEAT requests of a single operation and return the mean in microseconds
+def time_op(client, route, make_body):
+    start = time.perf_counter()
+    for i in range(REPEAT):
+        client.post(route, json=make_body(i))
+    return (time.perf_counter() - start) / REPEAT * 1e6
+
+
+# Run every operation against a server holding n rooms and n users
+def run(n):
+    reset()
+    client = server.app.test_client()
+    populate(client, n)
+    last = n - 1
+    results = {}
+    results["join"] = time_op(client, "/join-room",
+                              lambda i: {"user-name": f"user{last}", "room-name": f"room{i % n}"})
+    results["send"] = time_op(client, "/add-message",
+                              lambda i: {"user-name": f"user{last}", "room-name": f"room{last}", "message": "hi"})
+    results["can-send"] = time_op(client, "/can-send",
+                                  lambda i: {"user-name": f"user{last}", "room-name": f"room{last}"})
+    results["leave"] = time_op(client, "/leave-room",
+                               lambda i: {"user-name": f"user{last}", "room-name": f"room{i % n}"})
+    count = min(REPEAT, n)
+    start = time.perf_counter()
+    for i in range(count):
+        client.post("/remove-user", json={"user-name": f"user{i}"})
+    results["remove-user"] = (time.perf_counter() - start) / count * 1e6
+    return results
+
+
+# Measure the memory used per message kept in memory
+def memory(n=100000):
+    room = server.Room("memory", window_size=n)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(n):
+        room.append_message(f"user{i % 100}", "hello there, how are you?", float(i))
+    used = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    print(f"{used / n:.1f} bytes per message ({n} messages of 25 characters)")
+
+
+# Run random operations from several threads at once and check that the state is consistent.
+# Rooms room0-room3 are never removed so every message sent to them must be there.
+def stress(threads=8, ops=3000):
+    reset()
+    server.app.testing = True
+    client = server.app.test_client()
+    room_names = [f"room{i}" for i in range(8)]
+    user_names = [f"user{i}" for i in range(16)]
+    for name in room_names:
+        client.post("/create-room", json={"room-name": name, "window-size": 20})
+    for name in user_names:
+        client.post("/add-user", json={"user-name": name})
+
+    def worker(seed):
+        rnd = random.Random(seed)
+        client = server.app.test_client()
+        sent = Counter()
+        for _ in range(ops):
+            user = rnd.choice(user_names)
+            room = rnd.choice(room_names)
+            action = rnd.random()
+            if action < 0.25:
+                client.post("/join-room", json={"user-name": user, "room-name": room})
+            elif action < 0.35:
+                client.post("/leave-room", json={"user-name": user, "room-name": room})
+            elif action < 0.65:
+                result = client.post("/add-message", json={"user-name": user, "room-name": room, "message": "hi"})
+                if result.status_code == 200:
+                    sent[room] += 1
+            elif action < 0.85:
+                client.post("/get-messages", json={"room-name": room, "after": rnd.randrange(50)})
+            elif action < 0.92:
+                client.post("/remove-user", json={"user-name": user})
+                client.post("/add-user", json={"user-name": user})
+            elif room not in room_names[:4]:
+                client.post("/remove-room", json={"room-name": room})
+                client.post("/create-room", json={"room-name": room, "window-size": 20})
+        return sent
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as pool:
+        results = list(pool.map(worker, range(threads)))
+    elapsed = time.perf_counter() - start
+
+    errors = []
+    for name, room in server.rooms.items():
+        for u in room.users:
+            if server.users.get(u.user_name) is not u or room not in u.rooms:
+                errors.append(f"{u.user_name} is a member of {name} but does not have it joined")
+        ids = [m.get_id() for m in room.get_messages()]
+        if ids != list(range(1, room.last_message_id() + 1)):
+            errors.append(f"message ids of {name} are not contiguous")
+    for name, user in server.users.items():
+        for r in user.rooms:
+            if server.rooms.get(r.room_name) is not r or user not in r.users:
+                errors.append(f"{name} has {r.room_name} joined but is not a member")
+    sent = sum(results, Counter())
+    for name in room_names[:4]:
+        if server.rooms[name].last_message_id() != sent[name]:
+            errors.append(f"{name} has {server.rooms[name].last_message_id()} messages, {sent[name]} were sent")
+    print(f"{threads * ops} operations from {threads} threads in {elapsed:.1f}s")
+    for error in errors:
+        print("* " + error)
+    print("> State is consistent." if not errors else f"* {len(errors)} inconsistencies found.")
+    return not errors
+
+
+def main():
+    ops = ["join", "send", "can-send", "leave", "remove-user"]
+    print("rooms/users".rjust(12) + "".join(op.rjust(14) for op in ops) + "   (us/request)")
+    for n in SIZES:
+        results = run(n)
+        print(str(n).rjust(12) + "".join(f"{results[op]:14.1f}" for op in ops))
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["memory"]:
+        memory()
+    elif sys.argv[1:] == ["stress"]:
+        sys.exit(0 if stress() else 1)
+    else:
+        if len(sys.argv) > 1:
+            SIZES = [int(a) for a in sys.argv[1:]]
+        main()
@@ -1,20 +1,542 @@
-from flask import Flask, request, jsonify
+from flask import Flask, Response, g, request, jsonify, stream_with_context
 from flask_cors import CORS
-from collections import deque
+from array import array
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
 from markupsafe import escape
+import atexit
+import bisect
+import glob
+import hashlib
+import itertools
+import json
+import logging
+import logging.handlers
+import mmap
+import os
+import queue
+import random
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
 
 app = Flask(__name__)
 CORS(app, resources={r"/*": {"origins": "*"}})
 
+# Default number of the newest messages of a room that are kept in memory
+HOT_WINDOW_SIZE = int(os.environ.get("CHAT_HOT_WINDOW_SIZE", 1000))
+# Number of spilled messages stored in each on-disk segment
+SEGMENT_SIZE = int(os.environ.get("CHAT_SEGMENT_SIZE", 10000))
+
+# Directory holding the write-ahead log and the snapshots, empty to keep the state in memory only
+DATA_DIR = os.environ.get("CHAT_DATA_DIR", "data")
+# Directory holding the spilled messages of all the rooms, under DATA_DIR by default or in a
+# temporary directory removed on exit when the state is only kept in memory
+SEGMENT_DIR = os.environ.get("CHAT_SEGMENT_DIR") or (os.path.join(DATA_DIR, "segments") if DATA_DIR else "")
+if not SEGMENT_DIR:
+    SEGMENT_DIR = tempfile.mkdtemp(prefix="chat-segments-")
+    atexit.register(shutil.rmtree, SEGMENT_DIR, True)
+# Names of the directory of a room under SEGMENT_DIR and of the files of its segments. Only
+# these are ever deleted, whatever else the directory holds.
+SEGMENT_ROOM_NAME = re.compile(r"[0-9a-f]{40}")
+SEGMENT_FILE_NAME = re.compile(r"[0-9]{8}\.(data|index)")
+# Seconds between checks for a new snapshot and WAL records needed before one is taken
+SNAPSHOT_INTERVAL = float(os.environ.get("CHAT_SNAPSHOT_INTERVAL", 60))
+SNAPSHOT_MIN_RECORDS = int(os.environ.get("CHAT_SNAPSHOT_MIN_RECORDS", 10000))
+# Set to 0 to skip the fsync of the write-ahead log (faster, but the last writes can be lost)
+WAL_FSYNC = os.environ.get("CHAT_WAL_FSYNC", "1") != "0"
+# Seconds between two tries to write the log after a write failed
+WAL_RETRY_INTERVAL = 1
+# Number of messages read per step while writing a snapshot
+SNAPSHOT_CHUNK = 10000
+# Number of messages past the hot window a room keeps while the state is restored, before
+# they are spilled to disk together
+RESTORE_SPILL_BATCH = 10000
+
+# Default and maximum number of seconds a /subscribe long-poll is held open
+SUBSCRIBE_TIMEOUT = 30
+SUBSCRIBE_MAX_TIMEOUT = 60
+# Maximum number of messages per room returned by one /subscribe response
+SUBSCRIBE_BATCH = 100
+# Maximum number of operations in one /batch request
+MAX_BATCH = 1000
+# Number of encoded /get-rooms and /get-messages responses kept, 0 disables the cache, their
+# total size in bytes and the size of the largest one kept
+RESPONSE_CACHE_SIZE = int(os.environ.get("CHAT_RESPONSE_CACHE_SIZE", 1024))
+RESPONSE_CACHE_BYTES = int(os.environ.get("CHAT_RESPONSE_CACHE_BYTES", 64 * 1024 * 1024))
+RESPONSE_CACHE_MAX_BODY = RESPONSE_CACHE_BYTES // 16
+
+# Size of an entry in a segment index file
+INDEX_ENTRY = struct.Struct("<Q")
+
+# Minimum level of the log records written, and the fraction of the records below WARNING
+# that are kept (1 keeps them all, 0.01 one in a hundred)
+LOG_LEVEL = os.environ.get("CHAT_LOG_LEVEL", "INFO").upper()
+LOG_SAMPLE_RATE = float(os.environ.get("CHAT_LOG_SAMPLE_RATE", 1))
+
+# Upper bounds in seconds of the buckets of the request latency histograms
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+                   0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+# Attributes every log record has, the other ones are the fields passed in extra
+RECORD_ATTRIBUTES = set(vars(logging.makeLogRecord({}))) | {"message", "asctime"}
+
+# Write each log record as one JSON object holding the event and its fields
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {"time": round(record.created, 6), "level": record.levelname, "event": record.getMessage()}
+        for key, value in vars(record).items():
+            if key not in RECORD_ATTRIBUTES:
+                entry[key] = value
+        return json.dumps(entry, default=str)
+
+logger = logging.getLogger("chat")
+
+# The request threads only put the records in a queue, a background thread formats
+# and writes them so a slow stdout does not hold the requests up. Below WARNING only a
+# LOG_SAMPLE_RATE fraction of the records is kept.
+def setup_logging():
+    records = queue.SimpleQueue()
+    handler = logging.handlers.QueueHandler(records)
+    if LOG_SAMPLE_RATE < 1:
+        handler.addFilter(lambda record: record.levelno >= logging.WARNING or random.random() < LOG_SAMPLE_RATE)
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    listener = logging.handlers.QueueListener(records, output)
+    logger.addHandler(handler)
+    logger.setLevel(LOG_LEVEL)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop)
+
+
+# Estimate a quantile from the counts of a latency histogram by interpolating inside the
+# bucket it falls in
+def quantile(counts, q):
+    rank = q * sum(counts)
+    seen = 0
+    for i, count in enumerate(counts):
+        if count and seen + count >= rank:
+            low = LATENCY_BUCKETS[i - 1] if i > 0 else 0.0
+            high = LATENCY_BUCKETS[min(i, len(LATENCY_BUCKETS) - 1)]
+            return low + (high - low) * (rank - seen) / count
+        seen += count
+    return 0.0
+
+
+# Request counts and latency histograms per route, exported in the Prometheus text format
+class Metrics:
+    def __init__(self, prefix):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.requests = {}
+        # [counts per bucket of LATENCY_BUCKETS and one for slower requests, total seconds] by endpoint
+        self.latencies = {}
+
+    def observe(self, endpoint, status, seconds):
+        i = bisect.bisect_left(LATENCY_BUCKETS, seconds)
+        with self.lock:
+            key = (endpoint, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            histogram = self.latencies.get(endpoint)
+            if histogram is None:
+                histogram = self.latencies[endpoint] = [[0] * (len(LATENCY_BUCKETS) + 1), 0.0]
+            histogram[0][i] += 1
+            histogram[1] += seconds
+
+    def render(self):
+        name = self.prefix + "_requests_total"
+        lines = [f"# TYPE {name} counter"]
+        with self.lock:
+            requests = sorted(self.requests.items())
+            latencies = [(endpoint, list(counts), total) for endpoint, (counts, total) in sorted(self.latencies.items())]
+        for (endpoint, status), count in requests:
+            lines.append(f'{name}{{endpoint="{endpoint}",status="{status}"}} {count}')
+        name = self.prefix + "_request_seconds"
+        lines.append(f"# TYPE {name} histogram")
+        quantiles = []
+        for endpoint, counts, total in latencies:
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), counts):
+                cumulative += count
+                lines.append(f'{name}_bucket{{endpoint="{endpoint}",le="{bound}"}} {cumulative}')
+            lines.append(f'{name}_sum{{endpoint="{endpoint}"}} {total}')
+            lines.append(f'{name}_count{{endpoint="{endpoint}"}} {cumulative}')
+            for q in (0.5, 0.9, 0.99):
+                quantiles.append(f'{name}_quantile{{endpoint="{endpoint}",quantile="{q}"}} '
+                                 f'{quantile(counts, q):.6f}')
+        lines.append(f"# TYPE {name}_quantile gauge")
+        lines.extend(quantiles)
+        return "\n".join(lines) + "\n"
+
+
+# Append-only on-disk storage for the messages that fell out of a room's hot window.
+# Messages are grouped in segments of SEGMENT_SIZE. Each segment has a data file with
+# one JSON record per message and an index file with the end offset of every record, and
+# both are read back through mmap so only the requested records are loaded.
+# Appends are done with the room lock held. Reads take no lock: count is only advanced once
+# the records and their index entries are flushed to the files.
+class SegmentStore:
+    def __init__(self, path):
+        self.path = path
+        remove_segment_files(path)
+        os.makedirs(path, exist_ok=True)
+        # Number of messages stored so far
+        self.count = 0
+        # Files of the segment currently being appended to
+        self.data_file = None
+        self.index_file = None
+        self.offset = 0
+
+    def segment_paths(self, segment):
+        base = os.path.join(self.path, f"{segment:08d}")
+        return base + ".data", base + ".index"
+
+    # Close the current segment and start appending to the given one
+    def open_segment(self, segment):
+        self.close_files()
+        data_path, index_path = self.segment_paths(segment)
+        self.data_file = open(data_path, "ab")
+        self.index_file = open(index_path, "ab")
+        self.offset = 0
+
+    def close_files(self):
+        if self.data_file != None:
+            self.data_file.close()
+            self.index_file.close()
+            self.data_file = None
+            self.index_file = None
+
+    # Append (user_name, msg, timestamp) rows to the end of the store
+    def extend(self, rows):
+        i = 0
+        while i < len(rows):
+            if self.count % SEGMENT_SIZE == 0:
+                self.open_segment(self.count // SEGMENT_SIZE)
+            # The rows that still fit in the current segment
+            batch = rows[i:i + SEGMENT_SIZE - self.count % SEGMENT_SIZE]
+            index = array("Q")
+            for user_name, msg, timestamp in batch:
+                # The same as json.dumps of the row, without its per call overhead
+                record = f"[{encode_basestring_ascii(user_name)}, {encode_basestring_ascii(msg)}, " \
+                         f"{timestamp!r}]\n".encode()
+                self.data_file.write(record)
+                self.offset += len(record)
+                index.append(self.offset)
+            self.index_file.write(index.tobytes())
+            self.data_file.flush()
+            self.index_file.flush()
+            self.count += len(batch)
+            i += len(batch)
+
+    # Read the (user_name, msg, timestamp) records of the messages at positions start <= pos < end
+    def read(self, start, end):
+        end = min(end, self.count)
+        records = []
+        pos = start
+        while pos < end:
+            segment = pos // SEGMENT_SIZE
+            first = segment * SEGMENT_SIZE
+            stop = min(end, first + SEGMENT_SIZE)
+            data_path, index_path = self.segment_paths(segment)
+            with open(data_path, "rb") as df, open(index_path, "rb") as xf, \
+                    mmap.mmap(df.fileno(), 0, access=mmap.ACCESS_READ) as data, \
+                    mmap.mmap(xf.fileno(), 0, access=mmap.ACCESS_READ) as index:
+                for i in range(pos - first, stop - first):
+                    record_start = INDEX_ENTRY.unpack_from(index, (i - 1) * INDEX_ENTRY.size)[0] if i > 0 else 0
+                    record_end = INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)[0]
+                    records.append(json.loads(data[record_start:record_end]))
+            pos = stop
+        return records
+
+    # Close the files and delete everything stored on disk
+    def destroy(self):
+        self.close_files()
+        remove_segment_files(self.path)
+
+
+# Delete the segment files in the directory of a room, and the directory once empty
+def remove_segment_files(path):
+    try:
+        names = os.listdir(path)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if SEGMENT_FILE_NAME.fullmatch(name):
+            os.remove(os.path.join(path, name))
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass
+
+# Delete the segments of every room, left by an earlier run
+def clear_segments():
+    try:
+        names = os.listdir(SEGMENT_DIR)
+    except FileNotFoundError:
+        return
+    for name in names:
+        if SEGMENT_ROOM_NAME.fullmatch(name):
+            remove_segment_files(os.path.join(SEGMENT_DIR, name))
+
+
+# Append-only log of every state change, used to rebuild the state after a restart.
+# Records are JSON lines [lsn, op, args...] with increasing log sequence numbers.
+# Writers only queue their record, a background thread writes and fsyncs whatever has
+# been queued in one go (group commit) and sync() waits until a record is on disk.
+# The log is split in files named after their first lsn so the part covered by a
+# snapshot can be deleted.
+# When a write or fsync fails the waiting requests get a LogWriteError, the part of the
+# records that reached the file is cut off and they are written again every
+# WAL_RETRY_INTERVAL seconds until it works.
+class WriteAheadLog:
+    def __init__(self, directory, next_lsn):
+        self.directory = directory
+        # Protects the queue, the lsn counters and error
+        self.condition = threading.Condition()
+        # Held while writing to the current file
+        self.io_lock = threading.Lock()
+        self.queue = []
+        self.next_lsn = next_lsn
+        self.durable_lsn = next_lsn - 1
+        # The error of the last write, None once a write worked
+        self.error = None
+        # Records taken from the queue that are not on disk yet, the size of the file once the
+        # records before them were written and whether a failed write may have left some bytes after it
+        self.unwritten = []
+        self.size = 0
+        self.torn = False
+        self.fd = None
+        self.rotate()
+        threading.Thread(target=self.run, name="wal-writer", daemon=True).start()
+
+    # Queue a record and return its lsn
+    def append(self, *op):
+        with self.condition:
+            lsn = self.next_lsn
+            self.next_lsn += 1
+            self.queue.append(json.dumps([lsn, *op]))
+            self.condition.notify_all()
+            return lsn
+
+    # Wait until the record with the given lsn is on disk
+    def sync(self, lsn):
+        with self.condition:
+            while self.durable_lsn < lsn:
+                if self.error != None:
+                    raise LogWriteError(self.error)
+                self.condition.wait()
+
+    # Write the queued records, and the ones a failed write left, to the current file
+    def write_queued(self):
+        with self.condition:
+            self.unwritten += self.queue
+            self.queue = []
+            last_lsn = self.next_lsn - 1
+        if not self.unwritten:
+            return
+        data = ("\n".join(self.unwritten) + "\n").encode()
+        try:
+            if self.torn:
+                os.ftruncate(self.fd, self.size)
+                self.torn = False
+            self.torn = True
+            view = memoryview(data)
+            while view:
+                view = view[os.write(self.fd, view):]
+            if WAL_FSYNC:
+                os.fsync(self.fd)
+        except Exception as e:
+            with self.condition:
+                self.error = e
+                self.condition.notify_all()
+            raise
+        self.size += len(data)
+        self.torn = False
+        self.unwritten = []
+        with self.condition:
+            self.error = None
+            self.durable_lsn = max(self.durable_lsn, last_lsn)
+            self.condition.notify_all()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.queue and not self.unwritten:
+                    self.condition.wait()
+            with self.io_lock:
+                try:
+                    self.write_queued()
+                except Exception as e:
+                    logger.error("cannot write the log", extra={"error": str(e), "records": len(self.unwritten)})
+                    time.sleep(WAL_RETRY_INTERVAL)
+
+    # Continue the log in a new file and return the first lsn that goes in it
+    def rotate(self):
+        with self.io_lock:
+            if self.fd != None:
+                self.write_queued()
+                os.close(self.fd)
+            with self.condition:
+                first_lsn = self.next_lsn
+                path = os.path.join(self.directory, f"wal-{first_lsn:012d}.log")
+                self.fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                self.size = os.fstat(self.fd).st_size
+                return first_lsn
+
+    # Delete the files that only hold records before the given lsn
+    def truncate(self, lsn):
+        files = wal_files(self.directory)
+        for (first, path), (next_first, _) in zip(files, files[1:]):
+            if next_first <= lsn:
+                os.remove(path)
+
+
+# Raised to the requests waiting for their changes to be logged when writing the log failed
+class LogWriteError(Exception):
+    pass
+
+
+# The write-ahead log files in a directory as (first lsn, path), oldest first
+def wal_files(directory):
+    files = []
+    for path in glob.glob(os.path.join(directory, "wal-*.log")):
+        files.append((int(os.path.basename(path)[4:-4]), path))
+    return sorted(files)
+
+json_decoder = json.JSONDecoder()
+
+# Read the JSON line records of a file, stopping at a torn last line. With repair the torn
+# line is cut off the file, so the records appended to it after a restart are not written
+# behind bytes that replay never gets past.
+def read_records(path, repair=False):
+    with open(path, "r+b" if repair else "rb") as f:
+        # End of the last complete record
+        valid = 0
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                text = line.decode()
+                record, end = json_decoder.raw_decode(text)
+            except ValueError:
+                break
+            if end != len(text) - 1:
+                break
+            valid += len(line)
+            yield record
+        if repair and valid < os.fstat(f.fileno()).st_size:
+            logger.warning("torn log record dropped", extra={"file": path, "offset": valid})
+            f.truncate(valid)
+            os.fsync(f.fileno())
+
+
+# Compact storage for the messages of a room kept in memory.
+# Instead of an object per message, the sender (as an interned user id), the timestamp
+# and the end offset of the text in a shared UTF-8 buffer are stored in typed arrays.
+# Message objects are only built for the messages a request asks for.
+# Removing from the front only moves head, the arrays are copied once half is unused.
+# Writers hold the room lock. Readers take no lock: they work on one capture of view,
+# which is replaced as a whole when head moves, and only read the messages counted by
+# offsets, which is appended to last.
+class MessageColumns:
+    __slots__ = ("view",)
+
+    def __init__(self):
+        # (id of the message at head, head, senders, timestamps, offsets, text)
+        # offsets[i] and offsets[i + 1] delimit the text of message i
+        self.view = (1, 0, array("I"), array("d"), array("Q", [0]), bytearray())
+
+    def __len__(self):
+        return len(self.view[4]) - 1 - self.view[1]
+
+    def append(self, user_name, msg, timestamp):
+        first_id, head, senders, timestamps, offsets, text = self.view
+        text += msg.encode()
+        senders.append(intern_user(user_name))
+        timestamps.append(timestamp)
+        offsets.append(len(text))
+
+    # Get the messages with start_id <= id < end_id that are kept in a view
+    def read(self, start_id, end_id, view=None):
+        first_id, head, senders, timestamps, offsets, text = view or self.view
+        count = len(offsets) - 1 - head
+        start = max(start_id, first_id) - first_id + head
+        end = min(end_id, first_id + count) - first_id + head
+        result = []
+        for i in range(start, end):
+            msg = text[offsets[i]:offsets[i + 1]].decode()
+            result.append(Message(first_id + i - head, user_names[senders[i]], msg, timestamps[i]))
+        return result
+
+    # The (user_name, msg, timestamp) rows of the count oldest messages
+    def oldest(self, count):
+        first_id, head, senders, timestamps, offsets, text = self.view
+        return [(user_names[senders[i]], text[offsets[i]:offsets[i + 1]].decode(), timestamps[i])
+                for i in range(head, head + count)]
+
+    # Remove the count oldest messages
+    def popleft(self, count=1):
+        first_id, head, senders, timestamps, offsets, text = self.view
+        head += count
+        if head >= 1024 and head * 2 >= len(senders):
+            # New arrays so readers of the current view are not affected
+            base = offsets[head]
+            self.view = (first_id + count, 0, senders[head:], timestamps[head:],
+                         array("Q", (offset - base for offset in offsets[head:])), text[base:])
+        else:
+            self.view = (first_id + count, head, senders, timestamps, offsets, text)
+
+
+# A client waiting on /subscribe for new messages in one or more rooms.
+# It registers itself in every room it follows and is woken when any of them changes.
+class Subscriber:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = False
+
+    # Called by a room when a message was added or the room was removed
+    def notify(self):
+        with self.condition:
+            self.pending = True
+            self.condition.notify_all()
+
+    # Wait until notified or the timeout expires, return True if notified
+    def wait(self, timeout):
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            notified = self.pending
+            self.pending = False
+            return notified
+
 
 # The class to represent a room
 class Room:
-    def __init__(self, room_name):
+    __slots__ = ("room_name", "lock", "users", "messages", "window_size", "segments",
+                 "subscribers", "closed", "version")
+
+    def __init__(self, room_name, window_size=HOT_WINDOW_SIZE):
         self.room_name = room_name
+        # Held to change the members or add messages. Messages are read without it.
+        self.lock = threading.Lock()
         # Current users joined the room
-        self.users = []
-        # Current messages in the room
-        self.messages = []
+        self.users = set()
+        # The newest messages in the room, the older ones are spilled to disk
+        self.messages = MessageColumns()
+        self.window_size = window_size
+        # The messages spilled to disk, created on the first spill
+        self.segments = None
+        # Clients waiting for new messages in this room
+        self.subscribers = set()
+        self.closed = False
+        # Changed on every new message, the ETag of the history is built from it
+        self.version = next(versions)
 
     # get the name of the room
     def get_name(self):
@@ -27,7 +549,7 @@ class Room:
     # Join a new user to the room
     def add_user(self, user):
         if not self.has_user(user):
-            self.users.append(user)
+            self.users.add(user)
             return True
         return False
 
@@ -43,29 +565,114 @@ class Room:
         return False
 
     # Add a new message to this room
-    def add_message(self, user, msg):
+    def add_message(self, user, msg, timestamp=None):
         if self.has_user(user):
-            self.messages.append(Message(user, msg))
+            self.append_message(user.user_name, msg, timestamp)
             return True
         return False
 
+    # Add a message without checking the sender, used when restoring the history. The messages
+    # past the window are spilled once there are more than spill_after of them.
+    def append_message(self, user_name, msg, timestamp=None, spill_after=0):
+        # Message ids start from 1 and are the position in the history plus one
+        self.messages.append(user_name, msg, time.time() if timestamp is None else timestamp)
+        self.version = next(versions)
+        if len(self.messages) > self.window_size + spill_after:
+            self.spill()
+        self.notify_subscribers()
+
+    def subscribe(self, subscriber):
+        self.subscribers.add(subscriber)
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+
+    # Wake up every client waiting on this room
+    def notify_subscribers(self):
+        for subscriber in tuple(self.subscribers):
+            subscriber.notify()
 
-    # Get all the messages of this room
-    def get_messages(self):
-        return self.messages
+    # Move the oldest messages in memory past the window to the on-disk segments
+    def spill(self):
+        count = len(self.messages) - self.window_size
+        if count <= 0:
+            return
+        if self.segments == None:
+            path = os.path.join(SEGMENT_DIR, hashlib.sha1(self.room_name.encode()).hexdigest())
+            self.segments = SegmentStore(path)
+        # Written to disk before they leave memory so readers find them in one or the other
+        self.segments.extend(self.messages.oldest(count))
+        self.messages.popleft(count)
+
+    # Id of the newest message in the room (0 if there are no messages)
+    def last_message_id(self):
+        first_id, head, senders, timestamps, offsets, text = self.messages.view
+        return first_id - 1 + len(offsets) - 1 - head
+
+    # Release the on-disk history of the room and wake its subscribers
+    def close(self):
+        self.closed = True
+        if self.segments != None:
+            self.segments.destroy()
+            self.segments = None
+        self.notify_subscribers()
+
+    # Get the messages of this room with after < id < before.
+    # With a limit, the oldest messages after the cursor are returned when
+    # after is given, otherwise the newest ones before the cursor.
+    def get_messages(self, after=None, before=None, limit=None):
+        view = self.messages.view
+        spilled = view[0] - 1
+        total = spilled + len(view[4]) - 1 - view[1]
+        start = 0 if after is None else max(after, 0)
+        end = total if before is None else min(max(before - 1, 0), total)
+        if limit is not None:
+            if after is not None:
+                end = min(end, start + limit)
+            else:
+                start = max(start, end - limit)
+        if start >= end:
+            return []
+        result = []
+        # Older messages are read back from disk. The store is read once since a concurrent
+        # close() of a removed room sets it to None.
+        if start < spilled:
+            segments = self.segments
+            if segments == None or self.closed:
+                return []
+            try:
+                records = segments.read(start, min(end, spilled))
+            except (OSError, ValueError):
+                # The files are gone if the room was removed meanwhile
+                if self.closed:
+                    return []
+                raise
+            for i, (user_name, msg, timestamp) in enumerate(records, start + 1):
+                result.append(Message(i, user_name, msg, timestamp))
+        result.extend(self.messages.read(start + 1, end + 1, view))
+        return result
 
 # Class representing a user
 class User:
+    __slots__ = ("user_name", "lock", "rooms", "removed", "version")
+
     def __init__(self, user_name):
         # The name of the user
         self.user_name = user_name
+        # Held to change the joined rooms, after the lock of the room
+        self.lock = threading.Lock()
+        # Set once the user is removed so it cannot join rooms anymore
+        self.removed = False
         # The rooms this user has joined
-        self.rooms = []
+        self.rooms = set()
+        # Changed when the user joins or leaves a room, used in the ETag of the room list
+        self.version = next(versions)
 
     # Join a room
     def join_room(self, room):
         if room not in self.rooms:
-            self.rooms.append(room)
+            self.rooms.add(room)
+            self.version = next(versions)
             return True
         return False
 
@@ -73,6 +680,7 @@ class User:
     def leave_room(self, room):
         if room in self.rooms:
             self.rooms.remove(room)
+            self.version = next(versions)
             return True
         return False
 
@@ -84,66 +692,517 @@ class User:
         return room in self.rooms
 
 
+# A message built from the room storage for a response. Only the sender's name is kept,
+# the sender may have been removed since.
 class Message:
-    def __init__(self, user, msg):
-        self.user = user
+    __slots__ = ("msg_id", "user_name", "msg", "timestamp")
+
+    def __init__(self, msg_id, user_name, msg, timestamp):
+        self.msg_id = msg_id
+        self.user_name = user_name
         self.msg = msg
+        self.timestamp = timestamp
+
+    def get_id(self):
+        return self.msg_id
 
     def get_message(self):
         return self.msg
 
-    def get_user(self):
-        return self.user
+    def get_user_name(self):
+        return self.user_name
+
+    def get_timestamp(self):
+        return self.timestamp
+
+
+# Interned user names: messages store the index of their sender in user_names.
+# Names are never removed so the senders of old messages can still be resolved.
+user_ids = {}
+user_names = []
+intern_lock = threading.Lock()
+
+def intern_user(user_name):
+    user_id = user_ids.get(user_name)
+    if user_id == None:
+        with intern_lock:
+            user_id = user_ids.get(user_name)
+            if user_id == None:
+                user_id = len(user_names)
+                user_names.append(user_name)
+                user_ids[user_name] = user_id
+    return user_id
+
+
+# Versions of the rooms, the users and the room directory all come from this counter so a
+# removed and re-created room or user never gets a version it had before. ETags also carry
+# SERVER_EPOCH so the ones handed out before a restart do not match.
+versions = itertools.count(1)
+SERVER_EPOCH = format(time.time_ns(), "x")
+# Changed when a room is created or removed
+directory_version = 0
+
+# The rooms by name, with their names also kept sorted so that the rooms starting with
+# a prefix can be listed a page at a time without going through the others.
+# Changed with registry_lock held like the plain dict it replaces.
+class RoomDirectory(dict):
+    def __init__(self):
+        super().__init__()
+        self.names = []
+
+    def __setitem__(self, room_name, room):
+        if room_name not in self:
+            bisect.insort(self.names, room_name)
+        super().__setitem__(room_name, room)
+
+    def __delitem__(self, room_name):
+        super().__delitem__(room_name)
+        del self.names[bisect.bisect_left(self.names, room_name)]
 
+    def pop(self, room_name, *default):
+        if room_name not in self:
+            return super().pop(room_name, *default)
+        room = self[room_name]
+        del self[room_name]
+        return room
 
+    def clear(self):
+        super().clear()
+        self.names.clear()
 
-# All the rooms
-rooms = []
-# All the users
-users = []
+    # Up to limit rooms (all of them if None or 0) whose name starts with prefix, after the room
+    # named after, and whether there are more
+    def page(self, prefix, after, limit):
+        names = self.names
+        i = bisect.bisect_left(names, prefix)
+        if after:
+            i = max(i, bisect.bisect_right(names, after))
+        end = i + limit + 1 if limit else None
+        rooms = []
+        for name in itertools.islice(names, i, end):
+            if not name.startswith(prefix):
+                break
+            # Removed since the names were read
+            room = self.get(name)
+            if room != None:
+                rooms.append(room)
+        if not limit:
+            return rooms, False
+        return rooms[:limit], len(rooms) > limit
+
+# All the rooms, indexed by room name
+rooms = RoomDirectory()
+# All the users, indexed by user name
+users = {}
 
 # Search if a room exists and return it
 def search_room(room_name):
-    for r in rooms:
-        if r.room_name == room_name:
-            return r
-    return None
+    return rooms.get(room_name)
 
 # search if a user exists and return it
 def search_user(user_name):
-    for u in users:
-        if u.user_name == user_name:
-            return u
-    return None
+    return users.get(user_name)
 
-@app.route("/create-room", methods=["POST"])
-def create_room():
-    data = request.json
+# Held to add or remove rooms and users. Changes to a room take the lock of the room and
+# changes to the rooms of a user the lock of the user as well, always in the order
+# registry_lock, room lock, user lock. Every change is logged with the lock that protects
+# it held, so the log has the changes of each room and user in the order they were applied.
+registry_lock = threading.Lock()
+# The write-ahead log, None when the state is only kept in memory
+wal = None
+
+# Log a state change, returns the lsn to pass to commit()
+def log(*op):
+    if wal != None:
+        return wal.append(*op)
+    return 0
+
+# Wait until a logged state change is durable, called before answering the request
+def commit(lsn):
+    if wal != None and lsn:
+        wal.sync(lsn)
+
+# Apply a logged state change while restoring the state.
+# Snapshots are taken while requests keep changing the state, so a snapshot can already
+# contain some of the changes replayed after it: every change only brings the state to
+# what it was right after it and messages carry their id to skip the ones already there.
+def replay(op, args):
+    # Messages first, they are most of the records
+    if op == "message":
+        room_name, user_name, msg, msg_id = args[:4]
+        # Logs written before messages had timestamps have one field less
+        timestamp = args[4] if len(args) > 4 else None
+        room = rooms.get(room_name)
+        if room != None and msg_id == room.last_message_id() + 1:
+            room.append_message(user_name, msg, timestamp, RESTORE_SPILL_BATCH)
+    elif op == "create-room":
+        room_name, window_size = args
+        if room_name not in rooms:
+            rooms[room_name] = Room(room_name, window_size)
+    elif op == "remove-room":
+        room = rooms.pop(args[0], None)
+        if room != None:
+            for u in room.users:
+                u.leave_room(room)
+            room.close()
+    elif op == "add-user":
+        if args[0] not in users:
+            users[args[0]] = User(args[0])
+    elif op == "remove-user":
+        user = users.pop(args[0], None)
+        if user != None:
+            for r in user.rooms:
+                r.remove_user(user)
+            user.rooms.clear()
+    elif op == "join" or op == "leave":
+        user = search_user(args[0])
+        room = search_room(args[1])
+        if user != None and room != None:
+            if op == "join":
+                user.join_room(room)
+                room.add_user(user)
+            else:
+                user.leave_room(room)
+                room.remove_user(user)
+
+# Write a snapshot of the state as the list of changes that rebuild it.
+# Everything logged before lsn is in the snapshot, the log is replayed from lsn on load.
+def write_snapshot(lsn):
+    path = os.path.join(DATA_DIR, "snapshot.log")
+    with open(path + ".tmp", "w") as f:
+        def write(*op):
+            f.write(json.dumps(op) + "\n")
+        write("snapshot", lsn)
+        for user_name in list(users):
+            write("add-user", user_name)
+        for room in list(rooms.values()):
+            with room.lock:
+                members = [u.user_name for u in room.users]
+            last_id = room.last_message_id()
+            write("create-room", room.room_name, room.window_size)
+            for user_name in members:
+                write("join", user_name, room.room_name)
+            # The history is read without locking, in chunks to bound the memory used
+            for after in range(0, last_id, SNAPSHOT_CHUNK):
+                if room.closed:
+                    break
+                for mo in room.get_messages(after, last_id + 1, SNAPSHOT_CHUNK):
+                    write("message", room.room_name, mo.get_user_name(), mo.get_message(), mo.get_id(),
+                          mo.get_timestamp())
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + ".tmp", path)
+
+# Take a snapshot and drop the part of the log it covers
+def take_snapshot():
+    lsn = wal.rotate()
+    write_snapshot(lsn)
+    wal.truncate(lsn)
+    logger.info("snapshot taken", extra={"lsn": lsn})
+    return lsn
+
+# Take a snapshot from time to time once enough changes were logged since the last one
+def snapshot_loop(last_lsn):
+    while True:
+        time.sleep(SNAPSHOT_INTERVAL)
+        if wal.next_lsn - last_lsn > SNAPSHOT_MIN_RECORDS:
+            try:
+                last_lsn = take_snapshot()
+            except OSError as e:
+                logger.error("cannot take snapshot", extra={"error": str(e)})
+
+# Rebuild the state from the latest snapshot and the log written after it,
+# then start logging and taking snapshots
+def load_state():
+    global wal
+    # Spilled messages are rebuilt from the snapshot and the log
+    clear_segments()
+    if not DATA_DIR:
+        return
+    os.makedirs(DATA_DIR, exist_ok=True)
+    start = time.monotonic()
+    snapshot_lsn = 1
+    snapshot_path = os.path.join(DATA_DIR, "snapshot.log")
+    if os.path.exists(snapshot_path):
+        records = read_records(snapshot_path)
+        snapshot_lsn = next(records)[1]
+        for record in records:
+            replay(record[0], record[1:])
+    next_lsn = snapshot_lsn
+    for first, path in wal_files(DATA_DIR):
+        for record in read_records(path, repair=True):
+            if record[0] >= snapshot_lsn:
+                replay(record[1], record[2:])
+            next_lsn = max(next_lsn, record[0] + 1)
+    for room in rooms.values():
+        room.spill()
+    wal = WriteAheadLog(DATA_DIR, next_lsn)
+    logger.info("state loaded", extra={"rooms": len(rooms), "users": len(users),
+                                       "seconds": round(time.monotonic() - start, 3)})
+    threading.Thread(target=snapshot_loop, args=(snapshot_lsn,), name="snapshots", daemon=True).start()
+
+# Read an optional non-negative integer parameter from the request body
+def get_int_param(data, name):
+    value = data.get(name)
+    if value is None:
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(name)
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(name)
+    if value < 0:
+        raise ValueError(name)
+    return value
+
+# Format a message for the JSON responses
+def message_info(mo):
+    return {"id": mo.get_id(), "user": mo.get_user_name(), "message": mo.get_message(),
+            "timestamp": mo.get_timestamp()}
+
+# The state changes below are shared by their routes and /batch. They take the locks they
+# need and return the response body, the status code and the lsn to commit.
+
+def op_create_room(data):
+    global directory_version
+    room_name = data.get('room-name')
+    if not room_name:
+        return {"error": "room-name is required to create a new room"}, 400, 0
+    try:
+        window_size = get_int_param(data, 'window-size')
+    except ValueError as e:
+        return {"error": f"{e} must be a non-negative integer"}, 400, 0
+    if window_size is None:
+        window_size = HOT_WINDOW_SIZE
+    lsn = None
+    with registry_lock:
+        if search_room(room_name) == None:
+            rooms[room_name] = Room(room_name, window_size)
+            directory_version = next(versions)
+            lsn = log("create-room", room_name, window_size)
+    if lsn is not None:
+        logger.info("room created", extra={"room": room_name})
+        return {"success": f"Room {room_name} created"}, 200, lsn
+    logger.warning("cannot create room", extra={"room": room_name})
+    return {"error": f"Cannot create {room_name}"}, 400, 0
+
+def op_remove_room(data):
+    global directory_version
     room_name = data.get('room-name')
     if not room_name:
-        return jsonify({"error": "room-name is required to create a new room"}), 400
-    if search_room(room_name) == None:
-        rooms.append(Room(room_name))
-        print("> Room " + room_name + " created.")
-        return jsonify({"success": f"Room {room_name} created"}), 200
-    print(f"* Cannot create room {room_name}.")
-    return jsonify({"error": f"Cannot create {room_name}"}), 400
+        return {"error": "room-name is required to remove a room"}, 400, 0
+    with registry_lock:
+        to_remove = rooms.pop(room_name, None)
+        if to_remove != None:
+            with to_remove.lock:
+                to_remove.close()
+                # Drop the room from the joined set of its members
+                for u in to_remove.users:
+                    with u.lock:
+                        u.leave_room(to_remove)
+                directory_version = next(versions)
+                lsn = log("remove-room", room_name)
+    if to_remove != None:
+        logger.info("room removed", extra={"room": room_name})
+        return {"success": f"Room {room_name} removed"}, 200, lsn
+    logger.warning("cannot remove room", extra={"room": room_name})
+    return {"error": f"Cannot remove {room_name}"}, 400, 0
+
+def op_add_user(data):
+    user_name = data.get('user-name')
+    if not user_name:
+        return {"error": "user-name is required to add user"}, 400, 0
+    lsn = None
+    with registry_lock:
+        if search_user(user_name) == None:
+            users[user_name] = User(user_name)
+            lsn = log("add-user", user_name)
+    if lsn is not None:
+        logger.info("user added", extra={"user": user_name})
+        return {"success": f"User {user_name} was added"}, 200, lsn
+    logger.warning("cannot add user", extra={"user": user_name})
+    return {"error": f"Cannot add user {user_name}"}, 400, 0
+
+def op_remove_user(data):
+    user_name = data.get('user-name')
+    if not user_name:
+        return {"error": "user-name is required to remove user"}, 400, 0
+    with registry_lock:
+        to_remove = users.pop(user_name, None)
+        if to_remove != None:
+            # Once removed is set the user cannot join more rooms
+            with to_remove.lock:
+                to_remove.removed = True
+                joined = tuple(to_remove.rooms)
+            lsn = log("remove-user", user_name)
+    if to_remove != None:
+        # Only the rooms this user has joined need to be updated
+        for r in joined:
+            with r.lock:
+                with to_remove.lock:
+                    r.remove_user(to_remove)
+                    to_remove.leave_room(r)
+        logger.info("user removed", extra={"user": user_name})
+        return {"success": f"User {user_name} was removed"}, 200, lsn
+    logger.warning("cannot remove user", extra={"user": user_name})
+    return {"error": f"Cannot remove user {user_name}"}, 400, 0
+
+def op_join_room(data):
+    user_name = data.get('user-name')
+    room_name = data.get('room-name')
+    if not user_name or not room_name:
+        return {"error": "user-name and room-name are required to join room"}, 400, 0
+    user = search_user(user_name)
+    room = search_room(room_name)
+    lsn = None
+    if user != None and room != None:
+        with room.lock:
+            with user.lock:
+                if not room.closed and not user.removed and user.join_room(room) and room.add_user(user):
+                    lsn = log("join", user_name, room_name)
+    if lsn is not None:
+        logger.info("user joined room", extra={"user": user_name, "room": room_name})
+        return {"success": f"User {user_name} joined {room_name}"}, 200, lsn
+    logger.warning("user cannot join room", extra={"user": user_name, "room": room_name})
+    return {"error": f"User {user_name} cannot join {room_name}"}, 400, 0
+
+def op_leave_room(data):
+    user_name = data.get('user-name')
+    room_name = data.get('room-name')
+    if not user_name or not room_name:
+        return {"error": "user-name and room-name are required to leave room"}, 400, 0
+    user = search_user(user_name)
+    room = search_room(room_name)
+    lsn = None
+    if user != None and room != None:
+        with room.lock:
+            with user.lock:
+                if user.leave_room(room) and room.remove_user(user):
+                    lsn = log("leave", user_name, room_name)
+    if lsn is not None:
+        logger.info("user left room", extra={"user": user_name, "room": room_name})
+        return {"success": f"User {user_name} left {room_name}"}, 200, lsn
+    logger.warning("user cannot leave room", extra={"user": user_name, "room": room_name})
+    return {"error": f"User {user_name} cannot leave {room_name}"}, 400, 0
+
+def op_add_message(data):
+    user_name = data.get('user-name')
+    room_name = data.get('room-name')
+    msg = data.get('message')
+    if not user_name or not room_name or not msg:
+        return {"error": "user-name, room-name and message text are required to add message"}, 400, 0
+    user = search_user(user_name)
+    room = search_room(room_name)
+    lsn = None
+    if user != None and room != None:
+        with room.lock:
+            timestamp = time.time()
+            if not room.closed and not user.removed and room.add_message(user, msg, timestamp):
+                lsn = log("message", room_name, user_name, msg, room.last_message_id(), timestamp)
+    if lsn is not None:
+        logger.info("message sent", extra={"user": user_name, "room": room_name})
+        return {"success": f"User {user_name} sent message in room {room_name}"}, 200, lsn
+    logger.warning("user cannot send message", extra={"user": user_name, "room": room_name})
+    return {"error": f"User {user_name} cannot send message in room {room_name}"}, 400, 0
+
+def op_can_send(data):
+    user_name = data.get('user-name')
+    room_name = data.get('room-name')
+    if not user_name or not room_name:
+        return {"error": "user-name and room-name are required to see if can send message"}, 400, 0
+    user = search_user(user_name)
+    room = search_room(room_name)
+    if user == None or room == None or not user.can_send(room):
+        logger.warning("user cannot send message", extra={"user": user_name, "room": room_name})
+        return {"error": f"User {user_name} cannot send message in room {room_name}"}, 400, 0
+    return {"success": f"User {user_name} can send message in room {room_name}"}, 200, 0
+
+# Operations accepted by /batch
+batch_ops = {
+    "create-room": op_create_room,
+    "remove-room": op_remove_room,
+    "add-user": op_add_user,
+    "remove-user": op_remove_user,
+    "join-room": op_join_room,
+    "leave-room": op_leave_room,
+    "add-message": op_add_message,
+    "can-send": op_can_send,
+}
+
+# Encoded responses, least recently used first. Only the newest response of each query
+# (the room or user and the request fields) is kept along with its ETag: the ETag holds the
+# versions the response was built from, so once they change the older one can never be
+# served again. The entries are bounded in number and in total bytes, and bodies larger
+# than RESPONSE_CACHE_MAX_BODY are not kept at all.
+class ResponseCache:
+    def __init__(self, size, max_bytes):
+        self.size = size
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        # (etag, body) by query
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    def get(self, key, etag):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != etag:
+                return None
+            self.entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key, etag, body):
+        if self.size == 0 or len(body) > RESPONSE_CACHE_MAX_BODY:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= len(old[1])
+            self.entries[key] = (etag, body)
+            self.bytes += len(body)
+            while len(self.entries) > self.size or self.bytes > self.max_bytes:
+                self.bytes -= len(self.entries.popitem(last=False)[1][1])
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES)
+
+# Answer a read of the query key whose content is identified by etag: 304 when the client
+# already has it, otherwise the cached encoded body or the one of the payload built by make_payload.
+# The versions in the ETag must be read before the data so a concurrent change at worst
+# sends newer data under the older ETag, which the next request replaces.
+def versioned_response(key, etag, make_payload):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        body = response_cache.get(key, etag)
+        if body is None:
+            body = jsonify(make_payload()).get_data()
+            response_cache.put(key, etag, body)
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    return response
+
+# A change that could not be made durable is answered like a server error, it may or may not
+# be in the log once the write is retried
+@app.errorhandler(LogWriteError)
+def log_write_failed(e):
+    return jsonify({"error": f"The change could not be saved: {e}"}), 503
+
+# Run an operation for a single request
+def run_op(op):
+    result, status, lsn = op(request.json)
+    commit(lsn)
+    return jsonify(result), status
+
+@app.route("/create-room", methods=["POST"])
+def create_room():
+    return run_op(op_create_room)
 
 
 # Remove a room
 @app.route("/remove-room", methods=["POST"])
 def remove_room():
-    data = request.json
-    room_name = data.get('room-name')
-    if not room_name:
-        return jsonify({"error": "room-name is required to remove a room"}), 400
-    to_remove = search_room(room_name)
-    if to_remove != None:
-        rooms.remove(to_remove)
-        print(f"> Room {room_name} removed.")
-        return jsonify({"success": f"Room {room_name} removed"}), 200
-    print(f"* Cannot reamove room {room_name}.")
-    return jsonify({"error": f"Cannot remove {room_name}"}), 400
+    return run_op(op_remove_room)
 
 # Get all the rooms
 @app.route("/get-rooms", methods=["POST"])
@@ -152,116 +1211,55 @@ def get_rooms():
     user_name = data.get('user-name')
     if not user_name:
         return jsonify({"error": "user-name is required to get all the room"}), 400
+    prefix = data.get('prefix') or ''
+    after = data.get('after') or ''
+    if not isinstance(prefix, str) or not isinstance(after, str):
+        return jsonify({"error": "prefix and after must be strings"}), 400
+    try:
+        limit = get_int_param(data, 'limit')
+    except ValueError as e:
+        return jsonify({"error": f"{e} must be a non-negative integer"}), 400
     user = search_user(user_name)
-    rooms_list = ''
-    for room in rooms:
-        rooms_list += '\t' + room.get_name()
-        if(room.has_user(user)):
-            rooms_list += ' [joined]'
-        rooms_list += '\n'
-    print(f"> Listing the rooms for client {user.user_name}")
-    return jsonify({"success": rooms_list}), 200
+    logger.debug("rooms listed", extra={"user": user_name, "prefix": prefix})
+    # The list only changes with the rooms and with the rooms this user has joined. The query
+    # goes in as a hash since room names can hold characters an ETag cannot.
+    query = hashlib.sha1(json.dumps([limit, prefix, after]).encode()).hexdigest()[:20]
+    etag = f"{SERVER_EPOCH}-rooms-{directory_version}-{user.version if user != None else 0}-{query}"
+
+    def make_payload():
+        page, more = rooms.page(prefix, after, limit)
+        joined = user.rooms if user != None else ()
+        room_info = [{"name": room.room_name, "joined": room in joined} for room in page]
+        rooms_list = "".join(f"\t{r['name']}{' [joined]' if r['joined'] else ''}\n" for r in room_info)
+        # Cursor for the next page, None on the last one
+        next_after = room_info[-1]["name"] if more else None
+        return {"success": rooms_list, "rooms": room_info, "next-after": next_after}
+    return versioned_response(("rooms", user_name, query), etag, make_payload)
 
 # Add a new user
 @app.route("/add-user", methods=["POST"])
 def add_user():
-    data = request.json
-    user_name = data.get('user-name')
-    if not user_name:
-        return jsonify({"error": "user-name is required to add user"}), 400
-    if search_user(user_name) == None:
-        users.append(User(user_name))
-        print(f"> User {user_name} was added.")
-        return jsonify({"success": f"User {user_name} was added"}), 200
-    print(f"* Cannot add user {user_name}.")
-    return jsonify({"error": f"Cannot add user {user_name}"}), 400
+    return run_op(op_add_user)
 
 # # Remove a user
 @app.route("/remove-user", methods=["POST"])
 def remove_user():
-    data = request.json
-    user_name = data.get('user-name')
-    if not user_name:
-        return jsonify({"error": "user-name is required to remove user"}), 400
-    to_remove = search_user(user_name)
-    if to_remove != None:
-        users.remove(to_remove)
-        for r in rooms:
-            r.remove_user(to_remove)
-        print(f"> User {user_name} was removed.")
-        return jsonify({"success": f"User {user_name} was removed"}), 200
-    print(f"* Cannot remove user {user_name}.")
-    return jsonify({"error": f"Cannot remove user {user_name}"}), 400
+    return run_op(op_remove_user)
 
 # join a room
 @app.route("/join-room", methods=["POST"])
 def join_room():
-    data = request.json
-    user_name = data.get('user-name')
-    room_name = data.get('room-name')
-
-    if not user_name or not room_name:
-        return jsonify({"error": "user-name and room-name are required to join room"}), 400
-
-    user = search_user(user_name)
-    room = search_room(room_name)
-    if user == None or room == None:
-        print(f"* User {user_name} cannot join {room_name}")
-        return jsonify({"error": f"User {user_name} cannot join {room_name}"}), 400
-    result = user.join_room(room) and room.add_user(user)
-    if result == True:
-        print(f"> User {user_name} joined {room_name}")
-        return jsonify({"success": f"User {user_name} joined {room_name}"}), 200
-    else:
-        print(f"* User {user_name} cannot join {room_name}")
-        return jsonify({"error": f"User {user_name} cannot join {room_name}"}), 400
+    return run_op(op_join_room)
 
 # # Leave a room
 @app.route("/leave-room", methods=["POST"])
 def leave_room():
-    data = request.json
-    user_name = data.get('user-name')
-    room_name = data.get('room-name')
-
-    if not user_name or not room_name:
-        return jsonify({"error": "user-name and room-name are required to leave room"}), 400
-
-    user = search_user(user_name)
-    room = search_room(room_name)
-    if user == None or room == None:
-        print(f"* User {user_name} cannot leave {room_name}")
-        return jsonify({"error": f"User {user_name} cannot leave {room_name}"}), 400
-    result = user.leave_room(room) and room.remove_user(user)
-    if result == True:
-        print(f"> User {user_name} left {room_name}")
-        return jsonify({"success": f"User {user_name} left {room_name}"}), 200
-    else:
-        print(f"* User {user_name} cannot leave {room_name}")
-        return jsonify({"error": f"User {user_name} cannot leave {room_name}"}), 400
+    return run_op(op_leave_room)
 
 # Add a new message
 @app.route("/add-message", methods=["POST"])
 def add_message():
-    data = request.json
-    user_name = data.get('user-name')
-    room_name = data.get('room-name')
-    msg = data.get('message')
-
-    if not user_name or not room_name or not msg:
-        return jsonify({"error": "user-name, room-name and message text are required to add message"}), 400
-
-    user = search_user(user_name)
-    room = search_room(room_name)
-    if user == None or room == None:
-        print(f"* User {user_name} cannot send message in room {room_name}")
-        return jsonify({"error": f"User {user_name} cannot send message in room {room_name}"}), 400
-    result = room.add_message(user, msg)
-    if result == True:
-        print(f"> User {user_name} sent message in room {room_name}")
-        return jsonify({"success": f"User {user_name} sent message in room {room_name}"}), 200
-    else:
-        print(f"* User {user_name} cannot send message in room {room_name}")
-        return jsonify({"error": f"User {user_name} cannot send message in room {room_name}"}), 400
+    return run_op(op_add_message)
 
 # Get all the messages for a room
 @app.route("/get-messages", methods=["POST"])
@@ -270,33 +1268,219 @@ def get_messages():
     room_name = data.get('room-name')
     if not room_name:
         return jsonify({"error": "room-name is required to get messages"}), 400
-    print(f"> displaying messages in room {room_name}.")
+    try:
+        after = get_int_param(data, 'after')
+        before = get_int_param(data, 'before')
+        limit = get_int_param(data, 'limit')
+    except ValueError as e:
+        return jsonify({"error": f"{e} must be a non-negative integer"}), 400
+    logger.debug("messages read", extra={"room": room_name})
     room = search_room(room_name)
     if room == None:
         return jsonify({"error": f"Room {room_name} does not exist"}), 400
-    msg_objects = room.get_messages()
-    msg_list = []
-    for mo in msg_objects:
-        msg_list.append(mo.get_user().user_name + ':\n' + mo.get_message())
-    if len(msg_list) == 0:
+    version = room.version
+    last_id = room.last_message_id()
+    if last_id == 0:
         return jsonify({"error": f"No messages in room {room_name}"}), 400
-    else:
-        return jsonify({"success": msg_list}), 200
+    etag = f"{SERVER_EPOCH}-messages-{version}-{after}-{before}-{limit}"
+
+    def make_payload():
+        # Only the requested slice of the history is formatted
+        msg_objects = room.get_messages(after, before, limit)
+        msg_list = []
+        msg_info = []
+        for mo in msg_objects:
+            msg_list.append(mo.get_user_name() + ':\n' + mo.get_message())
+            msg_info.append(message_info(mo))
+        return {
+            "success": msg_list,
+            "messages": msg_info,
+            # Cursors for the next poll (after=last-id) or the previous page (before=first-id)
+            "first-id": msg_info[0]["id"] if msg_info else None,
+            "last-id": msg_info[-1]["id"] if msg_info else min(after if after is not None else last_id, last_id),
+        }
+    return versioned_response(("messages", room_name, after, before, limit), etag, make_payload)
 
 
 # Check if user can send message to a room
 @app.route("/can-send", methods=["POST"])
 def can_send():
+    return run_op(op_can_send)
+
+
+# Run several operations in one request.
+# The body is {"operations": [{"op": "join-room", "user-name": ..., "room-name": ...}, ...]}
+# with the same fields as the matching routes. The operations run in order, are made durable
+# together and the response has the body and status of each one.
+@app.route("/batch", methods=["POST"])
+def batch():
     data = request.json
-    user_name = data.get('user-name')
-    room_name = data.get('room-name')
+    operations = data.get('operations')
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operations are required to run a batch"}), 400
+    if len(operations) > MAX_BATCH:
+        return jsonify({"error": f"A batch can have at most {MAX_BATCH} operations"}), 400
+    results = []
+    last_lsn = 0
+    for operation in operations:
+        name = operation.get('op') if isinstance(operation, dict) else None
+        op = batch_ops.get(name)
+        if op == None:
+            results.append({"status": 400, "error": f"Unknown operation {name}"})
+            continue
+        result, status, lsn = op(operation)
+        result["status"] = status
+        results.append(result)
+        last_lsn = max(last_lsn, lsn)
+    # One wait covers every change of the batch
+    commit(last_lsn)
+    return jsonify({"success": results}), 200
 
-    if not user_name or not room_name:
-        return jsonify({"error": "user-name and room-name are required to see if can send message"}), 400
 
-    user = search_user(user_name)
-    room = search_room(room_name)
-    if user == None or room == None:
-        print(f"* User {user_name} cannot send message in room {room_name}")
-        return jsonify({"error": f"User {user_name} cannot send message in room {room_name}"}), 400
-    return jsonify({"success": f"User {user_name} can send message in room {room_name}"}), 200
+# Read the rooms to follow and their cursors from a /subscribe request.
+# The JSON body has "rooms": {"room-name": after, ...} (after may be null to only get new messages),
+# the query string has room=<name> repeated with optional matching after=<id> values.
+def get_subscription(data):
+    if data:
+        followed = data.get('rooms')
+        if isinstance(followed, list):
+            followed = {name: None for name in followed}
+        if not isinstance(followed, dict):
+            raise ValueError("rooms")
+        cursors = {}
+        for name, after in followed.items():
+            cursors[name] = get_int_param({'after': after}, 'after')
+        return cursors
+    names = request.args.getlist('room')
+    afters = request.args.getlist('after')
+    cursors = {}
+    for i, name in enumerate(names):
+        cursors[name] = get_int_param({'after': afters[i] if i < len(afters) else None}, 'after')
+    return cursors
+
+# Collect the messages past the cursor of every followed room and advance the cursors.
+# Removed rooms are dropped from the cursors and returned in the removed list.
+def collect_new_messages(followed, cursors):
+    new_messages = {}
+    removed = []
+    for name, room in list(followed.items()):
+        if room.closed:
+            removed.append(name)
+            del followed[name]
+            del cursors[name]
+            continue
+        msg_objects = room.get_messages(cursors[name], None, SUBSCRIBE_BATCH)
+        if msg_objects:
+            new_messages[name] = [message_info(mo) for mo in msg_objects]
+            cursors[name] = msg_objects[-1].get_id()
+    return new_messages, removed
+
+# Wait for new messages in one or more rooms.
+# By default this is a long-poll that returns as soon as there is something new in any of
+# the rooms or after the timeout, with the cursors to pass on the next call. With
+# "stream": true (or an Accept: text/event-stream header) the messages are pushed as
+# Server-Sent Events over the same connection until the client disconnects.
+@app.route("/subscribe", methods=["GET", "POST"])
+def subscribe():
+    data = request.get_json(silent=True) if request.method == "POST" else None
+    try:
+        cursors = get_subscription(data)
+        timeout = get_int_param(data or request.args, 'timeout')
+    except ValueError as e:
+        return jsonify({"error": f"{e} is not valid"}), 400
+    if not cursors:
+        return jsonify({"error": "rooms are required to subscribe"}), 400
+    timeout = SUBSCRIBE_TIMEOUT if timeout is None else min(timeout, SUBSCRIBE_MAX_TIMEOUT)
+    stream = (data or request.args).get('stream') in (True, "true", "1") or \
+        request.accept_mimetypes.best == "text/event-stream"
+
+    followed = {}
+    missing = []
+    for name in cursors:
+        room = search_room(name)
+        if room == None:
+            missing.append(name)
+        else:
+            followed[name] = room
+    for name in missing:
+        del cursors[name]
+    if not followed:
+        return jsonify({"error": "None of the rooms exist", "missing": missing}), 400
+    # Without a cursor only the messages sent from now on are returned
+    for name, room in followed.items():
+        if cursors[name] is None:
+            cursors[name] = room.last_message_id()
+
+    # Register before looking for messages so nothing is missed in between
+    subscriber = Subscriber()
+    for room in followed.values():
+        room.subscribe(subscriber)
+    logger.info("client subscribed", extra={"rooms": list(followed)})
+
+    def unsubscribe_all():
+        for room in followed.values():
+            room.unsubscribe(subscriber)
+
+    if stream:
+        def events():
+            try:
+                yield "retry: 1000\n\n"
+                while followed:
+                    new_messages, removed = collect_new_messages(followed, cursors)
+                    for name, msgs in new_messages.items():
+                        for m in msgs:
+                            yield f"event: message\nid: {m['id']}\ndata: {json.dumps(dict(m, room=name))}\n\n"
+                    for name in removed:
+                        yield f"event: removed\ndata: {json.dumps({'room': name})}\n\n"
+                    # A full batch means more messages are already waiting
+                    if any(len(msgs) == SUBSCRIBE_BATCH for msgs in new_messages.values()):
+                        continue
+                    if not subscriber.wait(timeout):
+                        # Keep the connection alive through proxies
+                        yield ": keep-alive\n\n"
+            finally:
+                unsubscribe_all()
+        return Response(stream_with_context(events()), mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            new_messages, removed = collect_new_messages(followed, cursors)
+            remaining = deadline - time.monotonic()
+            if new_messages or removed or not followed or remaining <= 0:
+                break
+            subscriber.wait(remaining)
+    finally:
+        unsubscribe_all()
+    return jsonify({
+        "success": {name: [m["user"] + ':\n' + m["message"] for m in msgs] for name, msgs in new_messages.items()},
+        "messages": new_messages,
+        # Pass these back as the rooms of the next call
+        "cursors": cursors,
+        "removed": removed,
+        "missing": missing,
+    }), 200
+
+
+metrics = Metrics("chat")
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+
+# Count every routed request and time it until its response is ready
+@app.after_request
+def record_request(response):
+    start = g.get("request_start")
+    if start is not None and request.url_rule is not None and request.url_rule.rule != "/metrics":
+        metrics.observe(request.url_rule.rule, response.status_code, time.perf_counter() - start)
+    return response
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+
+setup_logging()
+load_state()
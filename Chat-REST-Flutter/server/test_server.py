@@ -0,0 +1,167 @@
+import glob
+import json
+import os
+import subprocess
+import sys
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Start the server on data_dir in a new process, run code with client bound to a Flask test
+# client and return what it printed. Each call is a restart of the server.
+def run_server(tmp_path, code):
+    env = dict(os.environ, CHAT_DATA_DIR=str(tmp_path / "data"), CHAT_LOG_LEVEL="ERROR")
+    script = f"import sys; sys.path.insert(0, {SERVER_DIR!r})\n" \
+             "import server\n" \
+             "client = server.app.test_client()\n" + code
+    result = subprocess.run([sys.executable, "-c", script], cwd=tmp_path, env=env,
+                            capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout
+
+
+def add_user(user_name):
+    return f"assert client.post('/add-user', json={{'user-name': {user_name!r}}}).status_code == 200\n"
+
+
+def wal_records(tmp_path):
+    records = []
+    for path in sorted(glob.glob(str(tmp_path / "data" / "wal-*.log"))):
+        with open(path, "rb") as f:
+            records.extend(json.loads(line) for line in f if line.endswith(b"\n"))
+    return records
+
+
+# A crash in the middle of the first write to a new log file leaves a file without any complete
+# record. The writes acknowledged after the restart must survive the next one.
+def test_torn_wal_file_is_repaired(tmp_path):
+    run_server(tmp_path, add_user("alice"))
+    next_lsn = wal_records(tmp_path)[-1][0] + 1
+    with open(tmp_path / "data" / f"wal-{next_lsn:012d}.log", "wb") as f:
+        f.write(b'[%d, "add-user", "car' % next_lsn)
+
+    run_server(tmp_path, add_user("bob"))
+    out = run_server(tmp_path, "print(sorted(server.users))")
+    assert out.strip() == "['alice', 'bob']"
+
+
+# A torn record after complete ones is cut off and the log continues after the complete ones
+def test_torn_wal_record_is_dropped(tmp_path):
+    run_server(tmp_path, add_user("alice"))
+    path = sorted(glob.glob(str(tmp_path / "data" / "wal-*.log")))[-1]
+    with open(path, "ab") as f:
+        f.write(b'[99, "add-user", "car')
+
+    run_server(tmp_path, add_user("bob"))
+    out = run_server(tmp_path, "print(sorted(server.users))")
+    assert out.strip() == "['alice', 'bob']"
+    assert [r[2] for r in wal_records(tmp_path) if r[1] == "add-user"] == ["alice", "bob"]
+
+
+# Starting the server only deletes the segment files it wrote itself, under the data directory
+def test_start_keeps_unrelated_files(tmp_path):
+    (tmp_path / "segments").mkdir()
+    (tmp_path / "segments" / "notes.txt").write_text("mine")
+    run_server(tmp_path, add_user("alice") +
+               "client.post('/create-room', json={'room-name': 'r', 'window-size': 1})\n"
+               "client.post('/join-room', json={'user-name': 'alice', 'room-name': 'r'})\n"
+               "for i in range(3):\n"
+               "    client.post('/add-message', json={'user-name': 'alice', 'room-name': 'r', 'message': str(i)})\n")
+    segments = tmp_path / "data" / "segments"
+    room_dir, = segments.iterdir()
+    (room_dir / "keep.txt").write_text("mine")
+    (segments / "keep.txt").write_text("mine")
+
+    out = run_server(tmp_path, "r = client.post('/get-messages', json={'room-name': 'r'}).json\n"
+                               "print([m['message'] for m in r['messages']])")
+    assert out.strip() == "['0', '1', '2']"
+    assert (tmp_path / "segments" / "notes.txt").read_text() == "mine"
+    assert (room_dir / "keep.txt").exists() and (segments / "keep.txt").exists()
+
+
+# Messages restored past the hot window are spilled to disk in batches and read back unchanged
+def test_restore_spills_history(tmp_path):
+    texts = [f'message "{i}" é中\\n' for i in range(25)]
+    run_server(tmp_path, add_user("alice") +
+               "client.post('/create-room', json={'room-name': 'r', 'window-size': 10})\n"
+               "client.post('/join-room', json={'user-name': 'alice', 'room-name': 'r'})\n"
+               f"for text in {texts!r}:\n"
+               "    client.post('/add-message', json={'user-name': 'alice', 'room-name': 'r', 'message': text})\n")
+    out = run_server(tmp_path, "import json\n"
+                               "r = client.post('/get-messages', json={'room-name': 'r'}).json\n"
+                               "print(json.dumps([[m['id'], m['message']] for m in r['messages']]))\n"
+                               "print(len(server.rooms['r'].messages), server.rooms['r'].segments.count)")
+    messages, sizes = out.splitlines()
+    assert json.loads(messages) == [[i + 1, text] for i, text in enumerate(texts)]
+    assert sizes == "10 15"
+
+
+# Room names and prefixes with quotes or non Latin-1 characters are paged through like the others
+def test_list_rooms_with_any_name(tmp_path):
+    out = run_server(tmp_path, add_user("alice") +
+                     "names = ['a\"b', 'a\"c', 'é中', 'plain']\n"
+                     "for name in names:\n"
+                     "    client.post('/create-room', json={'room-name': name})\n"
+                     "seen = []\n"
+                     "after = None\n"
+                     "while True:\n"
+                     "    r = client.post('/get-rooms', json={'user-name': 'alice', 'limit': 1, 'after': after})\n"
+                     "    assert r.status_code == 200, r.status_code\n"
+                     "    again = client.post('/get-rooms', json={'user-name': 'alice', 'limit': 1, 'after': after},\n"
+                     "                       headers={'If-None-Match': r.headers['ETag']})\n"
+                     "    assert again.status_code == 304\n"
+                     "    seen += [room['name'] for room in r.json['rooms']]\n"
+                     "    after = r.json['next-after']\n"
+                     "    if after is None:\n"
+                     "        break\n"
+                     "r = client.post('/get-rooms', json={'user-name': 'alice', 'prefix': '中é\"'})\n"
+                     "assert r.status_code == 200 and r.json['rooms'] == []\n"
+                     "print(seen == sorted(names))")
+    assert out.strip() == "True"
+
+
+# A failed write of the log answers the waiting request with a 503 instead of hanging it. The
+# records are written again once the disk works, without the part the failed write left behind.
+def test_failed_log_write(tmp_path):
+    run_server(tmp_path, add_user("alice"))
+    out = run_server(tmp_path, "import errno, os, time\n"
+                               "server.WAL_RETRY_INTERVAL = 0.1\n"
+                               "write = os.write\n"
+                               "def failing_write(fd, data):\n"
+                               "    if fd == server.wal.fd:\n"
+                               "        write(fd, data[:5])\n"
+                               "        raise OSError(errno.ENOSPC, 'No space left on device')\n"
+                               "    return write(fd, data)\n"
+                               "os.write = failing_write\n"
+                               "codes = [client.post('/add-user', json={'user-name': name}).status_code\n"
+                               "         for name in ('bob', 'carol')]\n"
+                               "os.write = write\n"
+                               "time.sleep(0.5)\n" + add_user("dave") +
+                               # One write, the log records go to stdout from another thread
+                               "sys.stdout.write(f'{codes}\\n')\n")
+    lines = out.splitlines()
+    assert [line for line in lines if not line.startswith("{")] == ["[503, 503]"]
+    assert any(json.loads(line)["event"] == "cannot write the log" for line in lines if line.startswith("{"))
+    out = run_server(tmp_path, "print(sorted(server.users))")
+    assert out.strip() == "['alice', 'bob', 'carol', 'dave']"
+
+
+# Polling a growing room keeps only its newest response in the cache
+def test_response_cache_keeps_newest(tmp_path):
+    out = run_server(tmp_path, add_user("alice") +
+                     "client.post('/create-room', json={'room-name': 'r'})\n"
+                     "client.post('/join-room', json={'user-name': 'alice', 'room-name': 'r'})\n"
+                     "for i in range(20):\n"
+                     "    client.post('/add-message', json={'user-name': 'alice', 'room-name': 'r', 'message': str(i)})\n"
+                     "    body = client.post('/get-messages', json={'room-name': 'r'}).get_data()\n"
+                     "cache = server.response_cache\n"
+                     "print(len(cache.entries), cache.bytes == len(body))")
+    assert out.strip() == "1 True"
+
+
+# Joins, leaves, messages, reads and removals from several threads at once leave the rooms and
+# the users consistent with each other and every accepted message in its room
+def test_concurrent_changes(tmp_path):
+    out = run_server(tmp_path, "import benchmark\n"
+                               "print(benchmark.stress(threads=8, ops=300))")
+    assert out.splitlines()[-1] == "True", out